@@ -1,6 +1,101 @@
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import time
+import zlib
+
+import numpy as np
+
 from handy_shader_functions import *
 
 
+def per_member(value, members):
+    # Broadcast a scalar tunable, or check a per-member sequence, for an
+    # ensemble of `members` independent colonies.
+    values = np.broadcast_to(np.asarray(value, dtype=np.float32), (members, ))
+    return np.ascontiguousarray(values)
+
+
+# Positions are passed by value rather than as templates, so a new brush
+# position or home does not compile, and cache, another kernel.
+vec2 = ti.types.vector(2, ti.f32)
+vec3 = ti.types.vector(3, ti.f32)
+
+# Compiled kernels are kept here across processes. The key Taichi stores
+# them under hashes the kernel source, its template arguments and the
+# ti.init options, random_seed included, so it is stable between runs of
+# the same code with the same seed.
+KERNEL_CACHE = os.environ.get(
+    "ANTCOLONY_KERNEL_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".ti_cache"))
+
+
+def init_taichi(arch, random_seed=0, **kwargs):
+    # ti.init with the project's kernel cache, which unlike Taichi's shared
+    # per-user one is not evicted by other projects filling it.
+    kwargs.setdefault("offline_cache", True)
+    kwargs.setdefault("offline_cache_file_path", KERNEL_CACHE)
+    kwargs.setdefault("offline_cache_max_size_of_files", 1024**3)
+    ti.init(arch=arch, random_seed=random_seed, **kwargs)
+
+
+# Bumped whenever the checkpoint layout changes.
+CHECKPOINT_VERSION = 3
+
+
+@ti.func
+def hash32(x):
+    # Wellons' lowbias32 integer hash.
+    h = ti.cast(x, ti.u32)
+    h ^= h >> 16
+    h *= ti.u32(0x7FEB352D)
+    h ^= h >> 15
+    h *= ti.u32(0x846CA68B)
+    h ^= h >> 16
+    return h
+
+
+@ti.func
+def counter_random(seed, a, b, c):
+    # Uniform in [0, 1) and a pure function of its keys, so a draw does not
+    # depend on which thread makes it or when.
+    h = hash32(
+        ti.cast(seed, ti.u32) ^ hash32(
+            ti.cast(a, ti.u32) ^ hash32(
+                ti.cast(b, ti.u32) ^ hash32(c))))
+    return ti.cast(h >> 8, ti.f32) * (1.0 / 16777216.0)
+
+
+def get_fields(obj, names):
+    return {name: getattr(obj, name).to_numpy() for name in names}
+
+
+def check_shape(name, value, shape):
+    if value.shape != shape:
+        raise ValueError(
+            "checkpoint field {} has shape {}, expected {}".format(
+                name, value.shape, shape))
+
+
+def set_fields(obj, state, names):
+    # from_numpy does not reject a smaller or larger array, so check first.
+    for name in names:
+        field = getattr(obj, name)
+        current = field.to_numpy()
+        value = np.asarray(state[name])
+        check_shape(name, value, current.shape)
+        if field.shape == ():
+            # 0-d fields export as (1, ) but only import as ().
+            value = value.reshape(())
+        field.from_numpy(np.asarray(value, dtype=current.dtype, order="C"))
+
+
 @ti.data_oriented
 class AntColony:
     def __init__(self,
@@ -10,98 +105,228 @@ class AntColony:
                  p_from_food=None):
         self.renderer = renderer
         self.size = renderer.size
+        self.sim = Simulation(renderer, ants, p_from_home, p_from_food)
         self.ants = ants
         self.p_from_home = p_from_home
         self.ph_color = ti.Vector([0.8, 0.8, 0.0])
         self.p_from_food = p_from_food
         self.pf_color = ti.Vector([0.0, 0.5, 0.9])
-        self.obstacle = Detectables(self.renderer, 0, 1, 1, 10)
-        self.foods = Detectables(self.renderer, 0, 2, 2, 20)
-        self.home_pos = ti.Vector.field(2, dtype=float, shape=(1, ))
-        self.home_radius = 0.02
+        self.obstacle = self.sim.obstacle
+        self.foods = self.sim.foods
+        self.home_pos = self.sim.home_pos
+        self.home_radius = self.sim.home_radius
         self.ants_radius = 0.001
         self.is_paused = ti.field(dtype=ti.i32, shape=[])
+        # Simulation steps per rendered frame, or with target_fps > 0, keep
+        # stepping until the frame budget is spent.
+        self.substeps = 1
+        self.target_fps = 0
+        self.last_frame = time.perf_counter()
+        self.recorder = None
+        # Circles drawn on the canvas this frame, stamped into recordings.
+        self.overlays = []
+        self.metrics = self.sim.metrics
+        self.show_stats = False
+        self.frame_steps = 0
         self.window = renderer.window
         self.canvas = self.window.get_canvas()
+        # The window shows a square of the world, `1 / zoom` of its width
+        # and centred on `center`; images are composited per window pixel,
+        # so their cost follows the resolution rather than the world size.
+        self.res = renderer.res
+        self.center = [0.5, 0.5]
+        self.zoom = 1.0
+        self.view = ti.field(dtype=ti.f32, shape=3)
         self.image = ti.Vector.field(3,
                                      dtype=ti.f32,
-                                     shape=(self.size, self.size))
+                                     shape=(self.res, self.res))
+        # Obstacles and food, redrawn only when either map or the view
+        # changes.
+        self.static_image = ti.Vector.field(3,
+                                            dtype=ti.f32,
+                                            shape=(self.res, self.res))
+        self.static_key = None
+        self.ants_view = None
+        self.home_view = ti.Vector.field(2,
+                                         dtype=ti.f32,
+                                         shape=self.home_pos.shape)
 
     def set_ants(self, ants):
         self.ants = ants
+        self.sim.ants = ants
 
     def create_new_ants(self, N, speed, dt=1e-3):
-        self.ants = Ants(N, speed, dt)
+        self.set_ants(Ants(N, speed, dt))
 
     def draw_canvas(self):
         self.canvas.set_image(self.renderer.get_image())
 
-    @ti.kernel
-    def set_pheromone(self):
-        for i, j in self.image:
-            self.image[i, j] += self.p_from_home.density_map[
-                i, j] * self.ph_color + self.p_from_food.density_map[
-                    i, j] * self.pf_color
+    def update_view(self):
+        extent = 1.0 / self.zoom
+        origin = [c - extent / 2 for c in self.center]
+        self.view.from_numpy(np.array(origin + [extent], dtype=np.float32))
+
+    def to_world(self, pos):
+        # Window coordinates to world coordinates.
+        extent = 1.0 / self.zoom
+        return [(c - extent / 2 + p * extent) % 1.0
+                for c, p in zip(self.center, pos[:2])]
+
+    def navigate(self):
+        # Arrow keys pan by a fiftieth of the view, z and x zoom in and out.
+        extent = 1.0 / self.zoom
+        for key, axis, step in ((ti.ui.LEFT, 0, -1), (ti.ui.RIGHT, 0, 1),
+                                (ti.ui.DOWN, 1, -1), (ti.ui.UP, 1, 1)):
+            if self.window.is_pressed(key):
+                self.center[axis] = (self.center[axis] +
+                                     step * extent / 50) % 1.0
+        if self.window.is_pressed("z"):
+            self.zoom = min(self.zoom * 1.05, 64.0)
+        if self.window.is_pressed("x"):
+            self.zoom = max(self.zoom / 1.05, 1.0)
+
+    @ti.func
+    def world_cell(self, i, j):
+        p = ti.Vector([self.view[0], self.view[1]]) + (ti.Vector(
+            [i, j]) + 0.5) / self.res * self.view[2]
+        return ti.cast(ti.floor(p * self.size), ti.i32) % self.size
 
     @ti.kernel
-    def set_food(self):
-        for i, j in self.image:
-            if self.foods.density_map[i, j] > 0:
-                self.image[i, j] = (0.7, 0.8, 0.2)
+    def project(self, pos: ti.template(), out: ti.template()):
+        # World positions to window positions, parking the ones outside the
+        # view off screen.
+        for k in pos:
+            p = (pos[k] - ti.Vector([self.view[0], self.view[1]])) % 1.0
+            p /= self.view[2]
+            if p.max() > 1.0:
+                p = ti.Vector([-1.0, -1.0])
+            out[k] = p
 
     @ti.kernel
-    def set_obstacle(self):
-        for i, j in self.image:
-            if self.obstacle.density_map[i, j] == 1:
-                self.image[i, j] = (0.4, 0.4, 0.4)
+    def set_static(self):
+        for i, j in self.static_image:
+            p = self.world_cell(i, j)
+            if self.foods.read(0, p) > 0:
+                self.static_image[i, j] = (0.7, 0.8, 0.2)
+            elif self.obstacle.occupied(0, p):
+                self.static_image[i, j] = (0.4, 0.4, 0.4)
             else:
-                self.image[i, j] = (0.0, 0.0, 0.0)
+                self.static_image[i, j] = (0.0, 0.0, 0.0)
+
+    def update_static(self):
+        self.update_view()
+        key = (self.obstacle.version, self.foods.changes(),
+               tuple(self.center), self.zoom)
+        if key != self.static_key:
+            with self.metrics.timed("set_static"):
+                self.set_static()
+            self.static_key = key
 
     @ti.kernel
+    def composite(self, show_pheromone: ti.i32, scale: ti.f32):
+        for i, j in self.image:
+            p = self.world_cell(i, j)
+            color = self.static_image[i, j]
+            if show_pheromone:
+                color += self.p_from_home.read(
+                    0, p) * self.ph_color + self.p_from_food.read(
+                        0, p) * self.pf_color
+            self.image[i, j] = color * scale
+
     def set_puzzle(self):
-        for i in range(-10, 10):
-            for j in range(self.obstacle.size):
-                self.obstacle.density_map[i, j] = 1
-                self.obstacle.density_map[j, i] = 1
-            unit = int(self.obstacle.size / 5)
-            for j in range(unit, 5 * unit):
-                self.obstacle.density_map[i + 4 * unit, j] = 1
-            for j in range(unit, 4 * unit):
-                self.obstacle.density_map[i + unit, j] = 1
-                self.obstacle.density_map[j, i + 4 * unit] = 1
-            for j in range(unit, 2 * unit):
-                self.obstacle.density_map[j, i + unit] = 1
-                self.obstacle.density_map[j + 2 * unit, i + unit] = 1
-                self.obstacle.density_map[j + unit, i + 2 * unit] = 1
-                self.obstacle.density_map[j + unit, i + 3 * unit] = 1
-                self.obstacle.density_map[i + 3 * unit, j + 2 * unit] = 1
-                self.obstacle.density_map[i + 3 * unit, j + unit] = 1
+        self.sim.set_puzzle()
 
     def draw_image(self):
-        self.set_obstacle()
-        self.set_food()
-        if self.renderer.show_pheromone:
-            self.set_pheromone()
+        self.update_static()
+        with self.metrics.timed("composite"):
+            self.composite(self.renderer.show_pheromone, 1.0)
         self.canvas.set_image(self.image)
 
     def draw_slime(self):
-        self.set_pheromone()
-        self.canvas.set_image(self.image / 10.0)
+        self.update_static()
+        with self.metrics.timed("composite"):
+            self.composite(True, 0.1)
+        self.canvas.set_image(self.image)
 
     def draw_ants(self):
-        self.canvas.circles(self.ants.get_ants(), self.ants_radius,
+        pos = self.ants.get_ants()
+        if self.ants_view is None or self.ants_view.shape != pos.shape:
+            self.ants_view = ti.Vector.field(2, dtype=ti.f32, shape=pos.shape)
+        self.project(pos, self.ants_view)
+        if self.ants.dynamic:
+            self.ants.park_free(self.ants_view)
+        self.canvas.circles(self.ants_view, self.ants_radius,
                             (0.9, 0.9, 0.9))
+        self.overlays.append((self.ants_view, self.ants_radius,
+                              (0.9, 0.9, 0.9)))
 
     def draw_home(self):
-        self.canvas.circles(self.home_pos, self.home_radius, (0.5, 0.5, 1.0))
+        self.project(self.home_pos, self.home_view)
+        self.canvas.circles(self.home_view, self.sim.home_radius * self.zoom,
+                            (0.5, 0.5, 1.0))
+        self.overlays.append((self.home_view, self.sim.home_radius * self.zoom,
+                              (0.5, 0.5, 1.0)))
 
     def init(self):
         self.is_paused[None] = 1
-        self.foods.init()
-        self.ants.default_init()
-        self.p_from_food.init()
-        self.p_from_home.init()
-        self.obstacle.init()
+        self.sim.init(home=None)
+
+    def advance(self):
+        start = self.sim.steps
+        self.sim.step(self.substeps)
+        if self.target_fps > 0:
+            deadline = self.last_frame + 1.0 / self.target_fps
+            ti.sync()
+            while time.perf_counter() < deadline:
+                self.sim.step(self.substeps)
+                ti.sync()
+        self.frame_steps = self.sim.steps - start
+
+    def record(self, path, **kwargs):
+        self.recorder = Recorder(path, self.image.shape[0], **kwargs)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            recorder.close()
+
+    def stats_gui(self):
+        self.window.GUI.begin("Stats", 0.65, 0.05, 0.3, 0.5)
+        for line in self.metrics.lines():
+            self.window.GUI.text(line)
+        if self.window.GUI.button("Dump stats"):
+            self.metrics.dump("stats.json")
+        if self.window.GUI.button("Reset stats"):
+            self.metrics.reset()
+        self.window.GUI.end()
+
+    def show(self):
+        if self.recorder is not None:
+            self.recorder.capture(self.image, circles=self.overlays)
+        self.overlays = []
+        if self.show_stats:
+            self.stats_gui()
+        self.window.show()
+        now = time.perf_counter()
+        self.metrics.frame(now - self.last_frame, self.frame_steps)
+        self.last_frame = now
+
+    def schedule_gui(self):
+        self.substeps = self.window.GUI.slider_int("substeps", self.substeps,
+                                                   1, 64)
+        self.target_fps = self.window.GUI.slider_int("target fps",
+                                                     self.target_fps, 0, 120)
+        self.sim.release_interval = self.window.GUI.slider_int(
+            "release every", self.sim.release_interval, 1, 100)
+        self.zoom = self.window.GUI.slider_float("zoom", self.zoom, 1.0, 64.0)
+        self.show_stats = self.window.GUI.checkbox("Show stats?",
+                                                   self.show_stats)
+        self.metrics.timing = self.show_stats
+        if self.recorder is None:
+            if self.window.GUI.button("Record frames"):
+                self.record("frames")
+        elif self.window.GUI.button("Stop recording"):
+            self.stop_recording()
 
     def run(self):
         self.is_paused[None] = 1
@@ -111,14 +336,13 @@ class AntColony:
         self.home_pos[0] = [0.5, 0.5]
         for i in range(1000000):
             if self.window.running:
-                mouse = self.window.get_cursor_pos()
+                self.navigate()
+                mouse = self.to_world(self.window.get_cursor_pos())
                 if self.window.is_pressed(ti.ui.SPACE):
                     self.is_paused[None] = 0
                 if self.window.is_pressed("h") and self.window.is_pressed(
                         ti.ui.LMB):
-                    self.home_pos[0] = ti.Vector([mouse[0], mouse[1]])
-                    self.ants.set_random_circle(
-                        ti.Vector([mouse[0], mouse[1]]), self.home_radius)
+                    self.sim.set_home(mouse)
                 if self.window.is_pressed("f"):
                     if self.window.is_pressed(ti.ui.LMB):
                         self.foods.draw(ti.Vector([mouse[0], mouse[1]]), 2)
@@ -131,19 +355,13 @@ class AntColony:
                         self.obstacle.draw(ti.Vector([mouse[0], mouse[1]]), 0)
 
                 if self.is_paused[None] == 0:
-
-                    self.ants.move(self.home_pos, self.home_radius, self.foods,
-                                   self.size, self.obstacle)
-                    if i % 30 == 0:
-                        self.ants.release_pheromone(self.size)
-                    self.p_from_home.decay()
-                    self.p_from_food.decay()
+                    self.advance()
                 self.draw_image()
                 self.draw_home()
                 if self.renderer.show_ants:
                     self.draw_ants()
 
-                self.window.GUI.begin(self.renderer.name, 0.05, 0.05, 0.3, 0.4)
+                self.window.GUI.begin(self.renderer.name, 0.05, 0.05, 0.3, 0.65)
                 if self.window.GUI.button("Restart"):
                     self.init()
                 if self.window.GUI.button("Start"):
@@ -160,64 +378,1008 @@ class AntColony:
                     "Show ants?", self.renderer.show_ants)
                 self.renderer.show_pheromone = self.window.GUI.checkbox(
                     "Show pheromone?", self.renderer.show_pheromone)
+                self.schedule_gui()
                 self.window.GUI.end()
-                self.window.show()
+                self.show()
+            else:
+                break
+        self.stop_recording()
 
     def slime_run(self):
         self.is_paused[None] = 1
-        self.ants.slime_init()
-        self.p_from_food.init()
-        self.p_from_home.init()
+        self.sim.slime_init()
         for i in range(10000000):
             if self.window.running:
+                self.navigate()
                 if self.window.is_pressed(ti.ui.SPACE):
                     self.is_paused[None] = 0
                 if self.is_paused[None] == 0:
-                    self.ants.slime_move()
-                    if i % 1 == 0:
-                        self.ants.slime_release_p(self.size)
-                    self.p_from_home.decay()
-                    self.p_from_food.decay()
-                    # self.p_from_food.blur()
-                    # self.p_from_home.blur()
+                    self.advance()
                 self.draw_image()
                 # self.draw_ants()
-                self.window.GUI.begin("Slime!", 0.05, 0.05, 0.3, 0.3)
-                self.ants.detect_r[None] = self.window.GUI.slider_float(
-                    "det_r", self.ants.detect_r[None], 1, 40)
-                self.ants.detect_a[None] = self.window.GUI.slider_float(
-                    "det_a", self.ants.detect_a[None], 0.0, pi)
-                self.ants.sens[None] = self.window.GUI.slider_float(
-                    "sens", self.ants.sens[None], -10.0, 10.0)
-                self.ants.omgm[None] = self.window.GUI.slider_float(
-                    "omgm", self.ants.omgm[None], 0.0, 1.0)
+                self.window.GUI.begin("Slime!", 0.05, 0.05, 0.3, 0.55)
+                self.ants.detect_r[0] = self.window.GUI.slider_float(
+                    "det_r", self.ants.detect_r[0], 1, 40)
+                self.ants.detect_a[0] = self.window.GUI.slider_float(
+                    "det_a", self.ants.detect_a[0], 0.0, pi)
+                self.ants.sens[0] = self.window.GUI.slider_float(
+                    "sens", self.ants.sens[0], -10.0, 10.0)
+                self.ants.omgm[0] = self.window.GUI.slider_float(
+                    "omgm", self.ants.omgm[0], 0.0, 1.0)
+                if self.ants.slime_sensor == "sector":
+                    self.ants.sat_mode[None] = self.window.GUI.checkbox(
+                        "SAT sensing?", self.ants.sat_mode[None] == 1)
                 self.p_from_food.decay_rate[
-                    None] = self.window.GUI.slider_float(
-                        "dec_r_1", self.p_from_food.decay_rate[None], 0.0,
+                    0] = self.window.GUI.slider_float(
+                        "dec_r_1", self.p_from_food.decay_rate[0], 0.0,
                         20.0 * 1e-3)
                 self.p_from_home.decay_rate[
-                    None] = self.window.GUI.slider_float(
-                        "dec_r_2", self.p_from_home.decay_rate[None], 0.0,
+                    0] = self.window.GUI.slider_float(
+                        "dec_r_2", self.p_from_home.decay_rate[0], 0.0,
                         20.0 * 1e-3)
+                for name, things in (("diff_1", self.p_from_food),
+                                     ("diff_2", self.p_from_home)):
+                    if things.diffuse_radius:
+                        things.diffuse_rate[0] = self.window.GUI.slider_float(
+                            name, things.diffuse_rate[0], 0.0, 1.0)
+                self.schedule_gui()
 
                 self.window.GUI.end()
-                self.window.show()
+                self.show()
+            else:
+                break
+        self.stop_recording()
+
+
+@ti.data_oriented
+class Simulation:
+    def __init__(self, grid, ants, p_from_home, p_from_food):
+        self.size = grid.size
+        self.members = ants.members
+        for maps in (p_from_home, p_from_food):
+            if maps.members != self.members:
+                raise ValueError("pheromone maps have {} members, ants {}".
+                                 format(maps.members, self.members))
+        self.ants = ants
+        self.p_from_home = p_from_home
+        self.p_from_food = p_from_food
+        # Food follows the pheromone maps in being sparse.
+        sparse = p_from_home.sparse
+        self.obstacle = Obstacles(grid, 10, members=self.members)
+        self.foods = Detectables(grid,
+                                 0,
+                                 2,
+                                 2,
+                                 20,
+                                 nearest_field=True,
+                                 members=self.members,
+                                 storage="u8",
+                                 quantum=1.0,
+                                 sparse=sparse,
+                                 deterministic=p_from_home.deterministic)
+        self.home_pos = ti.Vector.field(2,
+                                        dtype=float,
+                                        shape=(self.members, ))
+        self.home_radius = 0.02
+        self.deterministic = ants.deterministic
+        self.mode = "ant"
+        self.release_interval = 30
+        self.steps = 0
+        self.autosave_path = None
+        self.autosave_every = 0
+        self.telemetry = None
+        self.metrics = self.ants.metrics
+
+    def init(self, home=(0.5, 0.5), seed=0):
+        self.mode = "ant"
+        self.release_interval = 30
+        self.steps = 0
+        self.set_seed(seed)
+        self.foods.init()
+        self.ants.default_init()
+        self.p_from_food.init()
+        self.p_from_home.init()
+        self.obstacle.init()
+        self.foods.init_brush()
+        self.obstacle.init_brush()
+        if home is not None:
+            self.home_pos.from_numpy(
+                np.tile(np.asarray(home, dtype=np.float32),
+                        (self.members, 1)))
+
+    def slime_init(self, seed=0):
+        self.mode = "slime"
+        self.release_interval = 1
+        self.steps = 0
+        self.set_seed(seed)
+        self.ants.slime_init()
+        self.p_from_food.init()
+        self.p_from_home.init()
+
+    def seeded(self):
+        return [self.ants, self.p_from_home, self.p_from_food, self.foods]
+
+    def set_seed(self, seed):
+        # Only used by deterministic parts; each gets its own stream.
+        for k, part in enumerate(self.seeded()):
+            part.seed[None] = (seed * 0x9E3779B1 + k) & 0xFFFFFFFF
+            part.tick[None] = 0
+
+    def set_home(self, pos):
+        self.home_pos.from_numpy(
+            np.tile(np.asarray(pos[:2], dtype=np.float32), (self.members, 1)))
+        self.ants.set_random_circle(ti.Vector([pos[0], pos[1]]),
+                                    self.home_radius)
+
+    @ti.kernel
+    def draw_puzzle(self):
+        for m, i in ti.ndrange(self.members, (-10, 10)):
+            for j in range(self.obstacle.size):
+                self.obstacle.set(m, ti.Vector([i, j]), 1)
+                self.obstacle.set(m, ti.Vector([j, i]), 1)
+            unit = int(self.obstacle.size / 5)
+            for j in range(unit, 5 * unit):
+                self.obstacle.set(m, ti.Vector([i + 4 * unit, j]), 1)
+            for j in range(unit, 4 * unit):
+                self.obstacle.set(m, ti.Vector([i + unit, j]), 1)
+                self.obstacle.set(m, ti.Vector([j, i + 4 * unit]), 1)
+            for j in range(unit, 2 * unit):
+                self.obstacle.set(m, ti.Vector([j, i + unit]), 1)
+                self.obstacle.set(m, ti.Vector([j + 2 * unit, i + unit]), 1)
+                self.obstacle.set(m, ti.Vector([j + unit, i + 2 * unit]), 1)
+                self.obstacle.set(m, ti.Vector([j + unit, i + 3 * unit]), 1)
+                self.obstacle.set(m, ti.Vector([i + 3 * unit, j + 2 * unit]),
+                                  1)
+                self.obstacle.set(m, ti.Vector([i + 3 * unit, j + unit]), 1)
+
+    def set_puzzle(self):
+        self.draw_puzzle()
+        self.obstacle.version += 1
+
+    def load_scenario(self, scenario):
+        # Replaces the obstacles and food with the scenario's, resampled to
+        # this grid, and moves home and the ants if it places a home.
+        grids = scenario.grids(self.size)
+        self.obstacle.from_numpy(grids["obstacle"])
+        self.foods.from_numpy(grids["food"])
+        if scenario.home_radius is not None:
+            self.home_radius = scenario.home_radius
+        if scenario.home is not None:
+            self.set_home(scenario.home)
+
+    def step(self, n=1):
+        for _ in range(n):
+            release = self.steps % self.release_interval == 0
+            timed = self.metrics.timed
+            if self.deterministic:
+                for part in self.seeded():
+                    part.tick[None] = self.steps + 1
+            if self.mode == "slime" and self.ants.slime_sensor != "sector":
+                with timed("slime_step"):
+                    self.ants.slime_step(release, self.size)
+                if release and self.deterministic:
+                    with timed("release_pheromone"):
+                        self.ants.slime_release_p(self.size)
+            elif self.mode == "slime":
+                self.ants.slime_move()
+                if release:
+                    with timed("release_pheromone"):
+                        self.ants.slime_release_p(self.size)
+            else:
+                with timed("nearest_food"):
+                    self.foods.update_nearest()
+                with timed("obstacle_distance"):
+                    self.obstacle.update_distance()
+                self.ants.move(self.home_pos, self.home_radius, self.foods,
+                               self.size, self.obstacle)
+                if release:
+                    with timed("release_pheromone"):
+                        self.ants.release_pheromone(self.size)
+                if self.ants.dynamic:
+                    with timed("population"):
+                        self.ants.update_population(self.home_pos,
+                                                    self.home_radius)
+            with timed("decay"):
+                self.p_from_home.decay()
+                self.p_from_food.decay()
+            self.steps += 1
+            if self.ants.sort_interval and (self.steps %
+                                            self.ants.sort_interval == 0):
+                with timed("sort"):
+                    self.ants.sort_by_cell()
+            elif self.ants.starve and self.ants.compact_interval and (
+                    self.steps % self.ants.compact_interval == 0):
+                with timed("compact"):
+                    self.ants.compact()
+            if self.steps % self.metrics.every == 0:
+                self.metrics.sample(self)
+            if self.autosave_every and self.steps % self.autosave_every == 0:
+                self.save(self.autosave_path)
+            if self.telemetry and self.steps % self.telemetry.every == 0:
+                with timed("telemetry"):
+                    self.telemetry.capture(self)
+
+    def parts(self):
+        return {
+            "ants": self.ants,
+            "p_from_home": self.p_from_home,
+            "p_from_food": self.p_from_food,
+            "foods": self.foods,
+            "obstacle": self.obstacle
+        }
+
+    def state(self):
+        state = {
+            "version": np.array(CHECKPOINT_VERSION),
+            "mode": np.array(self.mode),
+            "steps": np.array(self.steps),
+            "release_interval": np.array(self.release_interval),
+            "home_radius": np.array(self.home_radius),
+            "home_pos": self.home_pos.to_numpy()
+        }
+        for prefix, part in self.parts().items():
+            for name, value in part.state().items():
+                state[prefix + "." + name] = value
+        return state
+
+    def load_state(self, state):
+        version = int(state["version"])
+        if version != CHECKPOINT_VERSION:
+            raise ValueError("checkpoint version {} is not {}".format(
+                version, CHECKPOINT_VERSION))
+        for prefix, part in self.parts().items():
+            part.load_state({
+                key[len(prefix) + 1:]: state[key]
+                for key in state if key.startswith(prefix + ".")
+            })
+        set_fields(self, state, ["home_pos"])
+        self.mode = str(state["mode"])
+        self.steps = int(state["steps"])
+        self.release_interval = int(state["release_interval"])
+        self.home_radius = float(state["home_radius"])
+
+    def save(self, path, compress=True):
+        # A path ending in .npz gets one (compressed) archive, anything else
+        # a directory of .npy files that load() can memory-map. Either is
+        # written next to the target and swapped in, so an interrupted
+        # autosave never clobbers the last good checkpoint.
+        state = self.state()
+        tmp = path + ".tmp"
+        if path.endswith(".npz"):
+            with open(tmp, "wb") as f:
+                if compress:
+                    np.savez_compressed(f, **state)
+                else:
+                    np.savez(f, **state)
+            os.replace(tmp, path)
+            return
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for key, value in state.items():
+            np.save(os.path.join(tmp, key + ".npy"), value)
+        # A directory cannot replace another in one step, so the old one is
+        # moved aside until the new one is in place; load() falls back to
+        # it if the swap was interrupted in between.
+        old = path + ".old"
+        if os.path.isdir(path):
+            shutil.rmtree(old, ignore_errors=True)
+            os.replace(path, old)
+        os.replace(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def load(self, path, mmap=True):
+        if not os.path.exists(path) and os.path.isdir(path + ".old"):
+            path += ".old"
+        if os.path.isdir(path):
+            mode = "r" if mmap else None
+            state = {
+                name[:-len(".npy")]: np.load(os.path.join(path, name),
+                                             mmap_mode=mode)
+                for name in os.listdir(path) if name.endswith(".npy")
+            }
+            self.load_state(state)
+        else:
+            with np.load(path) as state:
+                self.load_state(state)
+
+    def checksum(self):
+        # Digest of the whole state. Deterministic runs from the same seed
+        # and parameters give the same digest after the same steps.
+        h = hashlib.sha1()
+        for key, value in sorted(self.state().items()):
+            h.update(key.encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        return h.hexdigest()
+
+    def autosave(self, path, every):
+        self.autosave_path = path
+        self.autosave_every = every
+
+    def record_telemetry(self, path, every=1, **kwargs):
+        # Streams samples into a telemetry ring file until called again, or
+        # with path None to stop.
+        if self.telemetry:
+            self.telemetry.close()
+        self.telemetry = None
+        if path is not None:
+            self.telemetry = Telemetry(self, path, every=every, **kwargs)
+        return self.telemetry
+
+    def run_until(self, condition, max_steps=None, check_every=1):
+        start = self.steps
+        while not condition(self):
+            if max_steps is not None and self.steps - start >= max_steps:
+                break
+            self.step(check_every)
+        return self.steps - start
+
+    def ant_steps(self):
+        if self.ants.dynamic:
+            return int(self.ants.ant_steps[None])
+        return self.steps * self.ants.N * self.members
+
+    def unbatch(self, arr):
+        # Per-member arrays lose their leading axis for a single colony.
+        if self.members == 1:
+            return arr[0]
+        return arr
+
+    def per_ant(self, field):
+        arr = field.to_numpy()
+        return self.unbatch(arr.reshape((self.members, self.ants.N) +
+                                        arr.shape[1:]))
+
+    def positions(self):
+        return self.per_ant(self.ants.pos)
+
+    def headings(self):
+        return self.per_ant(self.ants.theta)
+
+    def carrying(self):
+        return self.per_ant(self.ants.is_home)
+
+    def alive(self):
+        # Per-ant slots of a dynamic population; free ones read as 0.
+        alive = self.per_ant(self.ants.alive)
+        count = self.ants.count.to_numpy()
+        if self.members == 1:
+            alive[count[0]:] = 0
+        else:
+            for m, n in enumerate(count):
+                alive[m, n:] = 0
+        return alive
+
+    def population(self):
+        return self.unbatch(self.ants.live.to_numpy())
+
+    def delivered(self):
+        return self.unbatch(self.ants.delivered.to_numpy())
+
+    def coverage(self):
+        # Fraction of cells holding either pheromone.
+        a, b = self.p_from_home.to_numpy(), self.p_from_food.to_numpy()
+        return self.unbatch(((a > 0) | (b > 0)).mean(axis=(1, 2)))
+
+    def pheromones(self):
+        return (self.unbatch(self.p_from_home.to_numpy()),
+                self.unbatch(self.p_from_food.to_numpy()))
+
+    def food_map(self):
+        return self.unbatch(self.foods.to_numpy())
+
+    def obstacle_map(self):
+        return self.unbatch(self.obstacle.to_numpy())
+
+
+class Scenario:
+    # Obstacle, food and home layout of a world, independent of the grid
+    # size. Layers are arrays indexed [x, y] like the maps, resampled
+    # (nearest cell) once per grid size and optionally cached on disk.
+    EMPTY, OBSTACLE, FOOD, HOME = 0, 1, 2, 3
+
+    def __init__(self,
+                 obstacle=None,
+                 food=None,
+                 home=None,
+                 home_radius=None,
+                 sources=(),
+                 cache_dir=None):
+        self.obstacle = obstacle
+        self.food = food
+        self.home = home
+        self.home_radius = home_radius
+        self.sources = list(sources)
+        self.cache_dir = cache_dir
+        self.cache = {}
+
+    @classmethod
+    def from_labels(cls, labels, food_value=2.0, **kwargs):
+        # A home painted into the labels sits at the centroid of its cells,
+        # with the radius of a disk of the same area.
+        labels = np.asarray(labels)
+        home, home_radius = None, None
+        cells = np.argwhere(labels == cls.HOME)
+        if len(cells):
+            home = tuple(
+                float(x) for x in (cells.mean(axis=0) + 0.5) / labels.shape)
+            home_radius = float(
+                np.sqrt(len(cells) / np.pi) / labels.shape[0])
+        return cls(obstacle=labels == cls.OBSTACLE,
+                   food=np.where(labels == cls.FOOD, food_value, 0.0),
+                   home=home,
+                   home_radius=home_radius,
+                   **kwargs)
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        # A .json manifest names a "labels" file and/or separate "obstacle"
+        # and "food" layers (relative to the manifest) and may set "home",
+        # "home_radius" and "food_value". A .npy file holds labels; a PNG
+        # is drawn in black (obstacles), green (food) and red (home) on
+        # white.
+        if not path.endswith(".json"):
+            return cls.from_labels(read_labels(path),
+                                   sources=[path],
+                                   cache_dir=cache_dir)
+        with open(path) as f:
+            manifest = json.load(f)
+        root = os.path.dirname(path)
+        sources = [path]
+        food_value = manifest.get("food_value", 2.0)
+        layers = cls()
+        if "labels" in manifest:
+            sources.append(os.path.join(root, manifest["labels"]))
+            layers = cls.from_labels(read_labels(sources[-1]), food_value)
+        if "obstacle" in manifest:
+            sources.append(os.path.join(root, manifest["obstacle"]))
+            layers.obstacle = read_layer(sources[-1]) != 0
+        if "food" in manifest:
+            sources.append(os.path.join(root, manifest["food"]))
+            food = read_layer(sources[-1])
+            if food.dtype == bool:
+                food = np.where(food, food_value, 0.0)
+            layers.food = food
+        return cls(obstacle=layers.obstacle,
+                   food=layers.food,
+                   home=manifest.get("home", layers.home),
+                   home_radius=manifest.get("home_radius",
+                                            layers.home_radius),
+                   sources=sources,
+                   cache_dir=cache_dir)
+
+    def key(self, size):
+        # Changes with the grid size and with any source file.
+        h = hashlib.sha1(str(size).encode())
+        for path in self.sources:
+            stat = os.stat(path)
+            h.update("{}:{}:{}".format(os.path.abspath(path), stat.st_size,
+                                       stat.st_mtime_ns).encode())
+        return h.hexdigest()[:16]
+
+    def grids(self, size):
+        if size in self.cache:
+            return self.cache[size]
+        path = None
+        if self.cache_dir is not None and self.sources:
+            path = os.path.join(self.cache_dir,
+                                "{}-{}.npz".format(self.key(size), size))
+            if os.path.exists(path):
+                with np.load(path) as cached:
+                    self.cache[size] = dict(cached)
+                return self.cache[size]
+        grids = {
+            "obstacle": resample(self.obstacle, size, bool),
+            "food": resample(self.food, size, np.float32)
+        }
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, **grids)
+            os.replace(path + ".tmp", path)
+        self.cache[size] = grids
+        return grids
+
+
+def resample(layer, size, dtype):
+    if layer is None:
+        return np.zeros((size, size), dtype=dtype)
+    layer = np.asarray(layer)
+    rows = (np.arange(size) + 0.5) * layer.shape[0] // size
+    cols = (np.arange(size) + 0.5) * layer.shape[1] // size
+    return np.ascontiguousarray(
+        layer[rows.astype(int)[:, None], cols.astype(int)], dtype=dtype)
+
+
+def read_image(path):
+    # Indexed [x, y] with y up, like the maps.
+    image = ti.tools.imread(path).astype(np.int32)
+    if image.shape[2] < 3:
+        image = np.repeat(image[..., :1], 3, axis=2)
+    return image[..., :3]
+
+
+def read_layer(path):
+    # A layer image is set where it is bright; an array is used as is.
+    if path.endswith(".npy"):
+        return np.load(path)
+    return read_image(path).mean(axis=2) >= 128
+
+
+def read_labels(path):
+    if path.endswith(".npy"):
+        return np.load(path)
+    image = read_image(path)
+    r, g, b = image[..., 0], image[..., 1], image[..., 2]
+    labels = np.full(r.shape, Scenario.EMPTY, dtype=np.uint8)
+    labels[(r < 64) & (g < 64) & (b < 64)] = Scenario.OBSTACLE
+    labels[(g >= 128) & (r < 128) & (b < 128)] = Scenario.FOOD
+    labels[(r >= 128) & (g < 128) & (b < 128)] = Scenario.HOME
+    return labels
 
 
 @ti.data_oriented
 class Renderer:
-    def __init__(self, size, resolution, name="Ant Colony"):
+    def __init__(self, size, resolution, name="Ant Colony", headless=False):
         self.name = name
         self.size = size
         self.res = resolution
         self.bg_color = [0, 0, 0]
-        self.canvas = ti.Vector.field(3, dtype=ti.f32, shape=(size, size))
-        self.window = ti.ui.Window(self.name, (self.res, self.res))
+        self.canvas = ti.Vector.field(3,
+                                      dtype=ti.f32,
+                                      shape=(resolution, resolution))
+        self.window = None
+        if not headless:
+            self.window = ti.ui.Window(self.name, (self.res, self.res))
         self.show_ants = True
         self.show_pheromone = True
         self.show_home = True
 
 
+def write_png(path, rgb, level=3):
+    # Minimal RGB8 PNG writer; unlike ti.tools.imwrite, zlib releases the
+    # GIL while compressing, so encoding threads don't stall the caller.
+    height, width, _ = rgb.shape
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, -1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(
+            ">I", zlib.crc32(tag + data))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0,
+                                       0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), level)))
+        f.write(chunk(b"IEND", b""))
+
+
+@ti.data_oriented
+class Recorder:
+    # Frames are converted to RGB8 straight into one of a few preallocated
+    # buffers and handed to a background thread for encoding, so the
+    # simulation only pays for the copy. A path with a video extension is
+    # piped through ffmpeg, anything else is a directory of PNG frames.
+    # An encoding error stops the thread and is raised by the next capture
+    # or by close.
+    def __init__(self,
+                 path,
+                 size,
+                 buffers=4,
+                 every=1,
+                 fps=30,
+                 drop=True,
+                 ffmpeg_args=("-pix_fmt", "yuv420p")):
+        self.path = path
+        self.size = size
+        self.every = every
+        # When every buffer is still being encoded, either skip the frame
+        # or block until one is free.
+        self.drop = drop
+        self.frames = 0
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self.buffers = [
+            np.zeros((size, size, 3), dtype=np.uint8) for _ in range(buffers)
+        ]
+        self.free = queue.Queue()
+        for buffer in range(buffers):
+            self.free.put(buffer)
+        self.ready = queue.Queue()
+        self.pipe = None
+        if os.path.splitext(path)[1] in (".mp4", ".mkv", ".webm", ".gif"):
+            if shutil.which("ffmpeg") is None:
+                raise RuntimeError("recording {} needs ffmpeg".format(path))
+            self.pipe = subprocess.Popen(
+                [
+                    "ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo",
+                    "-pix_fmt", "rgb24", "-s", "{0}x{0}".format(size), "-r",
+                    str(fps), "-i", "-"
+                ] + list(ffmpeg_args) + [path],
+                stdin=subprocess.PIPE)
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+
+    @ti.kernel
+    def export_image(self, image: ti.template(), scale: ti.f32,
+                     arr: ti.types.ndarray()):
+        # Taichi images are indexed (x, y) from the bottom left; frames are
+        # stored as rows from the top.
+        for i, j in image:
+            for c in ti.static(range(3)):
+                arr[self.size - 1 - j, i, c] = ti.cast(
+                    min(max(image[i, j][c] * scale, 0.0), 1.0) * 255, ti.u8)
+
+    @ti.kernel
+    def export_map(self, things: ti.template(), m: ti.i32, scale: ti.f32,
+                   arr: ti.types.ndarray()):
+        for i, j in ti.ndrange(things.size, things.size):
+            v = ti.cast(
+                min(max(things.read(m, ti.Vector([i, j])) * scale, 0.0), 1.0)
+                * 255, ti.u8)
+            for c in ti.static(range(3)):
+                arr[self.size - 1 - j, i, c] = v
+
+    @ti.kernel
+    def export_circles(self, centers: ti.template(), radius: ti.f32,
+                       color: vec3, arr: ti.types.ndarray()):
+        # Filled circles as canvas.circles draws them, centres and radius in
+        # fractions of the frame; centres outside it are parked, not drawn.
+        # Ants smaller than a pixel still cover the one they are in.
+        r = max(radius * self.size, 0.5)
+        rgb = ti.cast(min(max(color, 0.0), 1.0) * 255, ti.u8)
+        for k in centers:
+            c = centers[k] * self.size
+            if c.min() >= 0.0 and c.max() <= self.size:
+                lo = ti.max(ti.cast(ti.floor(c - r), ti.i32), 0)
+                hi = ti.min(ti.cast(ti.ceil(c + r), ti.i32), self.size)
+                for x, y in ti.ndrange((lo[0], hi[0]), (lo[1], hi[1])):
+                    d = ti.Vector([x, y]) + 0.5 - c
+                    if d.norm() <= r or (ti.floor(c[0]) == x
+                                         and ti.floor(c[1]) == y):
+                        for ch in ti.static(range(3)):
+                            arr[self.size - 1 - y, x, ch] = rgb[ch]
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("recording {} failed".format(
+                self.path)) from self.error
+
+    def acquire(self):
+        self.check()
+        self.frames += 1
+        if (self.frames - 1) % self.every != 0:
+            return None
+        try:
+            buffer = self.free.get(block=not self.drop)
+        except queue.Empty:
+            self.dropped += 1
+            return None
+        # The encoder hands back its buffer when it fails, which is what
+        # woke a blocking wait.
+        self.check()
+        return buffer
+
+    def capture(self, image, scale=1.0, circles=()):
+        # circles are (centers, radius, color) as passed to canvas.circles.
+        buffer = self.acquire()
+        if buffer is not None:
+            self.export_image(image, scale, self.buffers[buffer])
+            for centers, radius, color in circles:
+                self.export_circles(centers, radius, color,
+                                    self.buffers[buffer])
+            self.ready.put(buffer)
+
+    def capture_map(self, things, m=0, scale=1.0):
+        if things.size != self.size:
+            raise ValueError("map of size {} recorded at {}".format(
+                things.size, self.size))
+        buffer = self.acquire()
+        if buffer is not None:
+            self.export_map(things, m, scale, self.buffers[buffer])
+            self.ready.put(buffer)
+
+    def encode(self):
+        while True:
+            buffer = self.ready.get()
+            if buffer is None:
+                break
+            frame = self.buffers[buffer]
+            try:
+                if self.pipe is not None:
+                    self.pipe.stdin.write(frame.data)
+                else:
+                    write_png(
+                        os.path.join(self.path,
+                                     "frame_{:06d}.png".format(self.written)),
+                        frame)
+            except Exception as e:
+                self.error = e
+                self.free.put(buffer)
+                break
+            self.written += 1
+            self.free.put(buffer)
+
+    def close(self):
+        self.ready.put(None)
+        self.thread.join()
+        if self.pipe is not None:
+            try:
+                self.pipe.stdin.close()
+            except OSError as e:
+                if self.error is None:
+                    self.error = e
+            status = self.pipe.wait()
+            if status != 0 and self.error is None:
+                self.error = RuntimeError(
+                    "ffmpeg exited with status {}".format(status))
+        self.check()
+
+
+TELEMETRY_MAGIC = b"ANTTELEM"
+TELEMETRY_VERSION = 1
+# One page: magic, version and header size, the number of frames written
+# so far at byte 16, then the length and JSON of the layout at byte 24.
+TELEMETRY_HEADER = 4096
+
+
+def telemetry_dtype(members, ants, maps, map_size):
+    # One frame of a telemetry ring. "frame" is -1 while the frame is being
+    # written, so readers can tell a torn frame from a finished one.
+    fields = [("frame", "<i8"), ("step", "<i8"),
+              ("pos", "<f4", (members, ants, 2)),
+              ("theta", "<f4", (members, ants)),
+              ("is_home", "<i4", (members, ants)),
+              ("alive", "<i4", (members, ants))]
+    fields += [(name, "<f4", (members, map_size, map_size)) for name in maps]
+    return np.dtype(fields, align=True)
+
+
+@ti.data_oriented
+class Telemetry:
+    # Ant states and downsampled maps every `every` steps, kept in a ring of
+    # `frames` preallocated frames in a memory-mapped file, so long runs
+    # write bounded output. Kernels write each sample straight into its
+    # slot of the mapping: sampling allocates nothing and does not wait on
+    # the disk, and other processes can map the file with TelemetryReader
+    # and read frames as they land.
+    #
+    # Every ant_stride-th slot of each member is sampled, up to max_ants;
+    # sorting and compaction move ants between slots. Maps are averaged
+    # over map_stride x map_stride cells and indexed [x, y].
+    def __init__(self,
+                 sim,
+                 path,
+                 frames=1024,
+                 every=1,
+                 ant_stride=1,
+                 max_ants=None,
+                 maps=("p_from_home", "p_from_food"),
+                 map_stride=4):
+        self.path = path
+        self.capacity = frames
+        self.every = every
+        self.members = sim.members
+        self.ant_stride = ant_stride
+        self.ants = len(range(0, sim.ants.N, ant_stride))
+        if max_ants is not None:
+            self.ants = min(self.ants, max_ants)
+        self.maps = tuple(maps)
+        self.map_stride = map_stride
+        self.map_size = (sim.size + map_stride - 1) // map_stride
+        self.dtype = telemetry_dtype(self.members, self.ants, self.maps,
+                                     self.map_size)
+        layout = json.dumps({
+            "frames": frames,
+            "every": every,
+            "members": self.members,
+            "ants": self.ants,
+            "ant_stride": ant_stride,
+            "maps": self.maps,
+            "map_size": self.map_size,
+            "map_stride": map_stride,
+            "size": sim.size
+        }).encode()
+        if 32 + len(layout) > TELEMETRY_HEADER:
+            raise ValueError("telemetry layout does not fit its header")
+        self.file = np.memmap(path,
+                              dtype=np.uint8,
+                              mode="w+",
+                              shape=(TELEMETRY_HEADER +
+                                     frames * self.dtype.itemsize, ))
+        self.file[:8] = np.frombuffer(TELEMETRY_MAGIC, dtype=np.uint8)
+        struct.pack_into("<II", self.file, 8, TELEMETRY_VERSION,
+                         TELEMETRY_HEADER)
+        struct.pack_into("<I", self.file, 24, len(layout))
+        self.file[32:32 + len(layout)] = np.frombuffer(layout, dtype=np.uint8)
+        self.written = np.ndarray((), "<u8", buffer=self.file, offset=16)
+        self.frames = np.ndarray((frames, ),
+                                 self.dtype,
+                                 buffer=self.file,
+                                 offset=TELEMETRY_HEADER)
+        self.frames["frame"] = -1
+        self.columns = {name: self.frames[name] for name in self.dtype.names}
+        self.count = 0
+
+    @ti.kernel
+    def export_ants(self, ants: ti.template(), pos: ti.types.ndarray(),
+                    theta: ti.types.ndarray(), is_home: ti.types.ndarray(),
+                    alive: ti.types.ndarray()):
+        for m, k in ti.ndrange(self.members, self.ants):
+            i = m * ants.N + k * self.ant_stride
+            pos[m, k, 0] = ants.pos[i][0]
+            pos[m, k, 1] = ants.pos[i][1]
+            theta[m, k] = ants.theta[i]
+            is_home[m, k] = ants.is_home[i]
+            alive[m, k] = ti.cast(ants.is_live(i), ti.i32)
+
+    @ti.kernel
+    def export_map(self, things: ti.template(), arr: ti.types.ndarray()):
+        s = self.map_stride
+        for m, u, v in ti.ndrange(self.members, self.map_size,
+                                  self.map_size):
+            total = 0.0
+            n = 0
+            for a, b in ti.ndrange(s, s):
+                i = u * s + a
+                j = v * s + b
+                if i < things.size and j < things.size:
+                    total += things.read(m, ti.Vector([i, j]))
+                    n += 1
+            arr[m, u, v] = total / n
+
+    def capture(self, sim):
+        slot = self.count % self.capacity
+        column = self.columns
+        column["frame"][slot] = -1
+        column["step"][slot] = sim.steps
+        if self.ants:
+            self.export_ants(sim.ants, column["pos"][slot],
+                             column["theta"][slot], column["is_home"][slot],
+                             column["alive"][slot])
+        for name in self.maps:
+            self.export_map(getattr(sim, name), column[name][slot])
+        ti.sync()
+        column["frame"][slot] = self.count
+        self.count += 1
+        self.written[...] = self.count
+
+    def close(self):
+        self.file.flush()
+
+
+class TelemetryReader:
+    # Maps a telemetry file read-only while it is being written, or after.
+    # Frames are views into the mapping, so reading one copies nothing.
+    def __init__(self, path):
+        self.file = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.file[:8]) != TELEMETRY_MAGIC:
+            raise ValueError("{} is not a telemetry file".format(path))
+        version, header = struct.unpack_from("<II", self.file, 8)
+        if version != TELEMETRY_VERSION:
+            raise ValueError("telemetry version {} is not {}".format(
+                version, TELEMETRY_VERSION))
+        length, = struct.unpack_from("<I", self.file, 24)
+        self.layout = json.loads(bytes(self.file[32:32 + length]))
+        self.capacity = self.layout["frames"]
+        self.dtype = telemetry_dtype(self.layout["members"],
+                                     self.layout["ants"], self.layout["maps"],
+                                     self.layout["map_size"])
+        self.count = np.ndarray((), "<u8", buffer=self.file, offset=16)
+        self.frames = np.ndarray((self.capacity, ),
+                                 self.dtype,
+                                 buffer=self.file,
+                                 offset=header)
+
+    def written(self):
+        return int(self.count)
+
+    def available(self):
+        # Numbers of the frames the ring still holds, oldest first.
+        n = self.written()
+        return range(max(0, n - self.capacity), n)
+
+    def frame(self, n):
+        # Frame n, or None if it is not written yet or was overwritten. The
+        # writer may reuse the slot while it is read; a frame(n) that is
+        # still not None afterwards shows the read was not torn.
+        record = self.frames[n % self.capacity]
+        if record["frame"] != n:
+            return None
+        return record
+
+
+class Metrics:
+    # Wall-clock time per simulation stage, throughput, and colony counters
+    # read back from fields every `every` steps. Stage timing syncs around
+    # each timed kernel, so it is only collected while `timing` is set.
+    def __init__(self, every=30):
+        self.every = every
+        self.timing = False
+        self.stages = {}
+        self.values = {}
+        self.last_steps = 0
+        self.last_time = time.perf_counter()
+        self.frame_time = 0.0
+        self.frame_steps = 0
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        if not self.timing:
+            yield
+            return
+        ti.sync()
+        t = time.perf_counter()
+        yield
+        ti.sync()
+        stage = self.stages.setdefault(name, [0, 0.0])
+        stage[0] += 1
+        stage[1] += time.perf_counter() - t
+
+    def sample(self, sim):
+        now = time.perf_counter()
+        sim.ants.count_states()
+        states = sim.ants.states.to_numpy().sum(axis=0)
+        steps = sim.steps - self.last_steps
+        elapsed = max(now - self.last_time, 1e-9)
+        self.values.update({
+            "steps": sim.steps,
+            "steps_per_sec": steps / elapsed,
+            "ant_steps_per_sec": steps * int(states.sum()) / elapsed,
+            "population": int(states.sum()),
+            "food_delivered": int(sim.ants.delivered.to_numpy().sum()),
+            "searching": int(states[0]),
+            "carrying": int(states[1])
+        })
+        self.last_steps = sim.steps
+        self.last_time = now
+
+    def frame(self, seconds, steps):
+        # Exponential moving average, so the overlay does not flicker.
+        self.frame_time += 0.1 * (seconds - self.frame_time)
+        self.frame_steps = steps
+
+    def reset(self):
+        self.stages = {}
+        self.values = {}
+
+    def snapshot(self):
+        snapshot = dict(self.values)
+        snapshot["frame_ms"] = self.frame_time * 1e3
+        snapshot["steps_per_frame"] = self.frame_steps
+        snapshot["stages"] = {
+            name: {
+                "calls": calls,
+                "total_s": total,
+                "avg_ms": total / calls * 1e3
+            }
+            for name, (calls, total) in self.stages.items()
+        }
+        if ti.lang.impl.current_cfg().kernel_profiler:
+            snapshot["kernel_profiler_total_s"] = (
+                ti.profiler.get_kernel_profiler_total_time())
+        return snapshot
+
+    def lines(self):
+        values = self.snapshot()
+        lines = [
+            "{}: {:.4g}".format(key, values[key]) for key in values
+            if key != "stages"
+        ]
+        for name, stage in sorted(values["stages"].items(),
+                                  key=lambda item: -item[1]["total_s"]):
+            lines.append("{}: {:.3f} ms".format(name, stage["avg_ms"]))
+        return lines
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
 @ti.data_oriented
 class Ants:
     def __init__(self,
@@ -228,10 +1390,43 @@ class Ants:
                  sensitivity,
                  clock_delta,
                  dt=1e-3,
-                 omgmax=pi * 0.05):
-        self.N = N
+                 omgmax=pi * 0.05,
+                 max_detect_r=40,
+                 headings=64,
+                 sat_sensing=False,
+                 members=1,
+                 detect_radius=14,
+                 sort_interval=0,
+                 capacity=None,
+                 spawn_per_food=0,
+                 starve=False,
+                 compact_interval=64,
+                 slime_sensor="sector",
+                 deterministic=False):
+        # Ensemble members are independent colonies stored member-major:
+        # ant i of member m lives at index m * N + i. Tunables may be given
+        # per member.
+        #
+        # Each member reserves `capacity` slots (N is then the number of
+        # ants it starts with) and kernels visit only the first count[m]
+        # slots. Every food delivered home spawns spawn_per_food ants
+        # there while slots are left, and with starve=True an ant whose
+        # internal clock runs out dies, leaving a hole that compaction
+        # closes every compact_interval steps.
+        if capacity is None:
+            capacity = N
+        if capacity < N:
+            raise ValueError("capacity {} is less than N {}".format(
+                capacity, N))
+        self.N = capacity
+        self.population = N
+        self.spawn_per_food = spawn_per_food
+        self.starve = starve
+        self.compact_interval = compact_interval
+        self.dynamic = spawn_per_food > 0 or starve
+        self.members = members
         self.speed = speed * dt
-        self.detect_radius = 14
+        self.detect_radius = detect_radius
         self.detect_angle = 1.0 * pi / 3
         self.sensitivity = sensitivity
         self.from_food = p_from_food
@@ -239,37 +1434,111 @@ class Ants:
         self.dt = dt
         self.omgmax = omgmax
         self.clock_max = 1.0
-        self.clock_delta = dt * clock_delta
-        self.pos = ti.Vector.field(2, dtype=ti.f32, shape=N)
-        self.internal_clock = ti.field(dtype=ti.f32, shape=N)
-        self.theta = ti.field(dtype=ti.f32, shape=N)
-        self.attraction = ti.field(dtype=ti.f32, shape=N)
-        self.is_home = ti.field(dtype=ti.i32, shape=N)
+        self.clock_delta = np.asarray(clock_delta, dtype=np.float32) * dt
+        self.pos = ti.Vector.field(2, dtype=ti.f32, shape=members * self.N)
+        self.internal_clock = ti.field(dtype=ti.f32, shape=members * self.N)
+        self.theta = ti.field(dtype=ti.f32, shape=members * self.N)
+        self.attraction = ti.field(dtype=ti.f32, shape=members * self.N)
+        self.is_home = ti.field(dtype=ti.i32, shape=members * self.N)
+        self.alive = ti.field(dtype=ti.i32, shape=members * self.N)
+        # Slots in use and live ants per member, food deliveries waiting to
+        # spawn, the longest count, and ant-steps run so far.
+        self.count = ti.field(dtype=ti.i32, shape=members)
+        self.live = ti.field(dtype=ti.i32, shape=members)
+        self.births = ti.field(dtype=ti.i32, shape=members)
+        self.span = ti.field(dtype=ti.i32, shape=())
+        self.ant_steps = ti.field(dtype=ti.i64, shape=())
+        # Food carried back home, and ants per is_home state, per member.
+        self.delivered = ti.field(dtype=ti.i32, shape=members)
+        self.states = ti.field(dtype=ti.i32, shape=(members, 2))
+        self.metrics = Metrics()
+
+        self.detect_r = ti.field(dtype=ti.f32, shape=members)
+        self.sens = ti.field(dtype=ti.f32, shape=members)
+        self.omgm = ti.field(dtype=ti.f32, shape=members)
+        self.detect_a = ti.field(dtype=ti.f32, shape=members)
+        self.clock_d = ti.field(dtype=ti.f32, shape=members)
+
+        # Sensing stencils: for every quantized heading, the window offsets
+        # grouped by sector (left, center, right), so detect_things needs no
+        # trigonometry. Rebuilt whenever detect_r or detect_a change.
+        self.max_detect_r = max_detect_r
+        self.headings = headings
+        self.stencil_offset = ti.Vector.field(2,
+                                              dtype=ti.i32,
+                                              shape=(members, headings,
+                                                     (2 * max_detect_r)**2))
+        self.stencil_start = ti.field(dtype=ti.i32,
+                                      shape=(members, headings, 4))
+        self.stencil_key = None
+
+        # Summed-area-table sensing: sector averages from a few box queries
+        # per ant, for maps created with summed_area=True.
+        self.sat_sensing = sat_sensing
+        self.sat_mode = ti.field(dtype=ti.i32, shape=())
+
+        # Slime sensing: "sector" averages the same sectors as the ants do,
+        # "point" and "bilinear" sample three taps detect_r cells ahead, at
+        # heading -detect_a, 0 and +detect_a, inside one fused
+        # sense-rotate-move-deposit kernel.
+        if slime_sensor not in ("sector", "point", "bilinear"):
+            raise ValueError("unknown slime sensor " + slime_sensor)
+        self.slime_sensor = slime_sensor
+
+        # Every sort_interval steps, reorder ants by the Z-order index of
+        # their cell so neighbouring iterations touch neighbouring memory.
+        self.sort_interval = sort_interval
+        self.sort_keys = np.zeros(members * self.N, dtype=np.uint32)
+
+        # Deterministic runs draw random numbers from counters keyed by the
+        # run seed, slot, step and call site, deposit with atomic max, and
+        # defer food pickups and obstacle washes to passes of their own, so
+        # results do not depend on thread scheduling.
+        self.deterministic = deterministic
+        self.seed = ti.field(dtype=ti.u32, shape=())
+        self.tick = ti.field(dtype=ti.i32, shape=())
+        self.took = None
+        self.wash = None
+        if deterministic:
+            self.took = ti.field(dtype=ti.i32, shape=members * self.N)
+            self.wash = ti.Vector.field(4,
+                                        dtype=ti.i32,
+                                        shape=members * self.N)
+
+    @ti.func
+    def random(self, i, site):
+        value = 0.0
+        if ti.static(self.deterministic):
+            value = counter_random(self.seed[None], i, self.tick[None], site)
+        else:
+            value = rand()
+        return value
 
-        self.detect_r = ti.field(dtype=ti.f32, shape=())
-        self.sens = ti.field(dtype=ti.f32, shape=())
-        self.omgm = ti.field(dtype=ti.f32, shape=())
-        self.detect_a = ti.field(dtype=ti.f32, shape=())
+    @ti.func
+    def random_unit(self, i, site):
+        a = self.random(i, site) * 2.0 * pi
+        return ti.Vector([ti.cos(a), ti.sin(a)])
 
     @ti.kernel
-    def set_uniform_pos(self, pos: ti.template()):
+    def set_uniform_pos(self, pos: vec2):
         for i in self.pos:
             self.pos[i] = pos
 
     @ti.kernel
-    def set_random_circle(self, pos: ti.template(), radius: ti.f32):
+    def set_random_circle(self, pos: vec2, radius: ti.f32):
         for i in self.pos:
-            self.pos[i] = pos + randUnit2D() * radius
+            self.pos[i] = pos + self.random_unit(i, 0) * radius
 
     @ti.kernel
-    def set_random_disk(self, pos: ti.template(), radius: ti.f32):
+    def set_random_disk(self, pos: vec2, radius: ti.f32):
         for i in self.pos:
-            self.pos[i] = pos + randUnit2D() * rand() * radius
+            self.pos[i] = pos + self.random_unit(i, 1) * self.random(
+                i, 2) * radius
 
     @ti.kernel
     def set_random_theta(self):
         for i in self.theta:
-            self.theta[i] = rand() * 2.0 * pi
+            self.theta[i] = self.random(i, 3) * 2.0 * pi
 
     @ti.kernel
     def init_clock(self):
@@ -278,139 +1547,453 @@ class Ants:
 
     def default_init(self):
         self.num_init()
+        self.reset_population()
+        self.delivered.fill(0)
         self.set_random_circle(ti.Vector([0.5, 0.5]), 0.02)
         self.set_random_theta()
         self.init_clock()
 
+    per_ant_fields = ("pos", "theta", "internal_clock", "is_home",
+                      "attraction", "alive")
+    state_fields = per_ant_fields + (
+        "delivered", "count", "live", "ant_steps", "detect_r", "sens", "omgm",
+        "detect_a", "clock_d", "sat_mode", "seed")
+
+    def state(self):
+        return get_fields(self, self.state_fields)
+
+    def load_state(self, state):
+        set_fields(self, state, self.state_fields)
+        self.update_span()
+
+    @ti.kernel
+    def reset_population(self):
+        for i in self.alive:
+            self.alive[i] = ti.cast(i % self.N < self.population, ti.i32)
+        for m in self.count:
+            self.count[m] = self.population
+            self.live[m] = self.population
+            self.births[m] = 0
+        self.span[None] = self.population
+        self.ant_steps[None] = 0
+
+    @ti.kernel
+    def update_span(self):
+        self.span[None] = 0
+        for m in self.count:
+            ti.atomic_max(self.span[None], self.count[m])
+
+    @ti.func
+    def is_live(self, i):
+        m = self.member(i)
+        return i - m * self.N < self.count[m] and self.alive[i] == 1
+
+    @ti.func
+    def slot(self, k):
+        # The ant visited by iteration k of a loop over members * span, or
+        # -1 for slots past a member's count and holes left by the dead.
+        # A single colony without starvation needs neither check.
+        i = k
+        if ti.static(self.members > 1):
+            m = k // self.span[None]
+            i = m * self.N + k - m * self.span[None]
+        if ti.static(self.members > 1 or self.starve):
+            if not self.is_live(i):
+                i = -1
+        return i
+
+    @ti.kernel
+    def update_population(self, home_pos: ti.template(),
+                          home_radius: ti.f32):
+        for m in range(self.members):
+            n = min(self.births[m], self.N - self.count[m])
+            for k in range(self.count[m], self.count[m] + n):
+                i = m * self.N + k
+                self.pos[i] = home_pos[m] + self.random_unit(
+                    i, 4) * home_radius
+                self.theta[i] = self.random(i, 5) * 2.0 * pi
+                self.internal_clock[i] = self.clock_max
+                self.is_home[i] = 0
+                self.attraction[i] = 0.0
+                self.alive[i] = 1
+            self.count[m] += n
+            self.live[m] += n
+            self.births[m] = 0
+        self.span[None] = 0
+        for m in range(self.members):
+            ti.atomic_max(self.span[None], self.count[m])
+            ti.atomic_add(self.ant_steps[None], self.live[m])
+
+    @ti.kernel
+    def compact(self):
+        # Stable, so a Morton order from sort_by_cell survives. Members run
+        # in parallel, each one's slots in order.
+        for m in range(self.members):
+            n = 0
+            for k in range(self.count[m]):
+                i = m * self.N + k
+                if self.alive[i] == 1:
+                    if n != k:
+                        j = m * self.N + n
+                        self.pos[j] = self.pos[i]
+                        self.theta[j] = self.theta[i]
+                        self.internal_clock[j] = self.internal_clock[i]
+                        self.is_home[j] = self.is_home[i]
+                        self.attraction[j] = self.attraction[i]
+                        self.alive[j] = 1
+                        self.alive[i] = 0
+                    n += 1
+            self.count[m] = n
+        self.span[None] = 0
+        for m in range(self.members):
+            ti.atomic_max(self.span[None], self.count[m])
+
+    @ti.kernel
+    def park_free(self, pos: ti.template()):
+        # Moves free slots of a drawing copy of pos off screen.
+        for i in pos:
+            if not self.is_live(i):
+                pos[i] = ti.Vector([-1.0, -1.0])
+
+    @ti.kernel
+    def set_tunables(self, values: ti.types.ndarray()):
+        for m in self.sens:
+            self.sens[m] = values[0, m]
+            self.omgm[m] = values[1, m]
+            self.detect_r[m] = values[2, m]
+            self.detect_a[m] = values[3, m]
+            self.clock_d[m] = values[4, m]
+
     def num_init(self):
-        self.sens[None] = self.sensitivity
-        self.omgm[None] = self.omgmax
-        self.detect_r[None] = self.detect_radius
-        self.detect_a[None] = self.detect_angle
+        # One upload rather than a from_numpy, and so a copy kernel, per
+        # field.
+        self.set_tunables(
+            np.stack([
+                per_member(value, self.members)
+                for value in (self.sensitivity, self.omgmax,
+                              self.detect_radius, self.detect_angle,
+                              self.clock_delta)
+            ]))
+        self.sat_mode[None] = self.sat_sensing
 
     def slime_init(self):
         self.num_init()
+        self.reset_population()
         self.set_random_disk(ti.Vector([0.5, 0.5]), 0.2)
         self.set_random_theta()
         self.set_half_home()
 
     @ti.kernel
     def set_half_home(self):
-        for i in range(self.N / 2):
-            self.is_home[i] = 1
+        for i in self.is_home:
+            if i % self.N < self.population // 2:
+                self.is_home[i] = 1
+
+    @ti.func
+    def member(self, idx):
+        return idx // self.N
+
+    @ti.kernel
+    def count_states(self):
+        for m, s in self.states:
+            self.states[m, s] = 0
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                ti.atomic_add(self.states[self.member(i), self.is_home[i]],
+                              1)
 
     @ti.kernel
     def random_ori(self):
-        for i in self.theta:
-            self.theta[i] += (rand() -
-                              0.5) * 2.0 * self.omgm[None] + self.attraction[i]
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                self.theta[i] += (self.random(i, 6) - 0.5) * 2.0 * self.omgm[
+                    self.member(i)] + self.attraction[i]
+
+    @ti.func
+    def get_sector(self, vec, theta, m):
+        sector = -1
+        d_angle = self.get_angle_diff(self.get_angle(vec), theta)
+        if self.detect_a[m] / 3 < d_angle <= self.detect_a[m] / 2:
+            sector = 0
+        elif self.detect_a[m] / 3 < 2 * pi - d_angle <= self.detect_a[m] / 2:
+            sector = 2
+        elif 0 < d_angle <= self.detect_a[
+                m] / 6 or 0 <= 2 * pi - d_angle < self.detect_a[m] / 6:
+            sector = 1
+        return sector
+
+    @ti.kernel
+    def build_stencil(self):
+        for m, h in ti.ndrange(self.members, self.headings):
+            r = min(ti.cast(self.detect_r[m], ti.i32), self.max_detect_r)
+            theta = h * 2 * pi / self.headings
+            n = 0
+            for s in ti.static(range(3)):
+                self.stencil_start[m, h, s] = n
+                for i in range(-r, r):
+                    for j in range(-r, r):
+                        vec = ti.Vector([i, j], ti.i32)
+                        if self.get_sector(vec, theta, m) == s:
+                            self.stencil_offset[m, h, n] = vec
+                            n += 1
+            self.stencil_start[m, h, 3] = n
+
+    @ti.func
+    def spread_bits(self, v):
+        # Moves bit k of a 16 bit value to bit 2k.
+        v = (v | (v << 8)) & ti.u32(0x00FF00FF)
+        v = (v | (v << 4)) & ti.u32(0x0F0F0F0F)
+        v = (v | (v << 2)) & ti.u32(0x33333333)
+        v = (v | (v << 1)) & ti.u32(0x55555555)
+        return v
+
+    @ti.kernel
+    def morton_keys(self, size: ti.i32, keys: ti.types.ndarray()):
+        for i in self.pos:
+            c = ti.cast(self.pos[i] * size, ti.i32) % size
+            keys[i] = self.spread_bits(ti.cast(
+                c[0], ti.u32)) | (self.spread_bits(ti.cast(c[1], ti.u32)) << 1)
+            # Free slots sort last, so sorting compacts as well.
+            if not self.is_live(i):
+                keys[i] = ti.u32(0xFFFFFFFF)
+
+    def sort_by_cell(self):
+        # The argsort runs on the host within each member, so ants never
+        # change colony; every per-ant field follows the same permutation.
+        self.morton_keys(self.from_food.size, self.sort_keys)
+        keys = self.sort_keys.reshape(self.members, self.N)
+        order = np.argsort(keys, axis=1, kind="stable")
+        order = (order + np.arange(self.members)[:, None] * self.N).ravel()
+        for name in self.per_ant_fields:
+            field = getattr(self, name)
+            field.from_numpy(field.to_numpy()[order])
+        self.count.from_numpy((keys != 0xFFFFFFFF).sum(axis=1).astype(
+            np.int32))
+        self.update_span()
+
+    def tunable(self, field):
+        # Reading one element is several times cheaper than to_numpy(),
+        # which matters for checks made every step.
+        if self.members == 1:
+            return field[0]
+        return tuple(field.to_numpy())
+
+    def update_stencil(self):
+        key = (self.tunable(self.detect_r), self.tunable(self.detect_a))
+        if key != self.stencil_key:
+            self.build_stencil()
+            self.stencil_key = key
 
     @ti.func
-    def detect_things(self, idx, things, is_obstacle=False):
+    def get_heading(self, theta):
+        h = ti.cast(ti.round(theta * self.headings / (2 * pi)), ti.i32)
+        return h % self.headings
+
+    @ti.func
+    def stencil_sectors(self, idx, things):
+        m = self.member(idx)
         center_index = ti.cast(self.pos[idx] * things.size, ti.i32)
+        h = self.get_heading(self.theta[idx])
         ds = ti.Vector([0.0, 0.0, 0.0], ti.f32)
-        ns = ti.Vector([0, 0, 0], ti.i32)
-        for i in range(-self.detect_r[None], self.detect_r[None]):
-            for j in range(-self.detect_r[None], self.detect_r[None]):
-                vec = ti.Vector([i, j], ti.i32)
-                c_vec = vec + center_index
-                d_angle = self.get_angle_diff(self.get_angle(vec),
-                                              self.theta[idx])
-                if self.detect_a[None] / 3 < d_angle <= self.detect_a[None] / 2:
-                    ds[0] += things.density_map[c_vec]
-                    ns[0] += 1
-                elif self.detect_a[
-                        None] / 3 < 2 * pi - d_angle <= self.detect_a[None] / 2:
-                    ds[2] += things.density_map[c_vec]
-                    ns[2] += 1
-                elif 0 < d_angle <= self.detect_a[
-                        None] / 6 or 0 <= 2 * pi - d_angle < self.detect_a[
-                            None] / 6:
-                    ds[1] += things.density_map[c_vec]
-                    ns[1] += 1
         for s in ti.static(range(3)):
-            if ns[s] != 0:
-                ds[s] /= ns[s]
-        if ds[0] > max(ds[1], ds[2]):
-            if is_obstacle:
-                self.attraction[idx] = -0.3  #* ds[0]
-            else:
-                self.attraction[idx] += min(self.sens[None] * (ds[0] - ds[2]),
-                                            self.detect_a[None] / 2)
-        elif ds[2] > max(ds[1], ds[0]):
-            if is_obstacle:
-                self.attraction[idx] = 0.3  #* ds[2]
+            start = self.stencil_start[m, h, s]
+            end = self.stencil_start[m, h, s + 1]
+            for k in range(start, end):
+                ds[s] += things.read(
+                    m,
+                    things.wrap(center_index + self.stencil_offset[m, h, k]))
+            if end > start:
+                ds[s] /= end - start
+        return ds
+
+    @ti.func
+    def sat_sectors(self, idx, things):
+        # Each sector is approximated by three boxes along its bisector,
+        # summed from the map's summed-area table.
+        m = self.member(idx)
+        center = self.pos[idx] * things.size
+        r = self.detect_r[m]
+        a = self.detect_a[m]
+        ds = ti.Vector([0.0, 0.0, 0.0], ti.f32)
+        for s in ti.static(range(3)):
+            mid = self.theta[idx] + (1 - s) * 5 * a / 12
+            half = a / 12
+            if ti.static(s == 1):
+                half = a / 6
+            direction = ti.Vector([ti.cos(mid), ti.sin(mid)])
+            total = 0.0
+            area = 0
+            for k in ti.static(range(3)):
+                d = (k + 0.5) * r / 3
+                w = max(d * ti.tan(half), 0.5)
+                c = center + d * direction
+                lo = ti.cast(ti.floor(c - w), ti.i32)
+                hi = ti.cast(ti.floor(c + w), ti.i32) + 1
+                for e in ti.static(range(2)):
+                    lo[e] = min(max(lo[e], 0), things.size)
+                    hi[e] = min(max(hi[e], 0), things.size)
+                total += things.box_sum(m, lo, hi)
+                area += max(hi[0] - lo[0], 0) * max(hi[1] - lo[1], 0)
+            if area > 0:
+                ds[s] = total / area
+        return ds
+
+    @ti.func
+    def detect_things(self, idx, things):
+        m = self.member(idx)
+        ds = ti.Vector([0.0, 0.0, 0.0], ti.f32)
+        if ti.static(things.summed_area):
+            if self.sat_mode[None] == 1:
+                ds = self.sat_sectors(idx, things)
             else:
-                self.attraction[idx] += -min(self.sens[None] * (ds[2] - ds[0]),
-                                             self.detect_a[None] / 2)
+                ds = self.stencil_sectors(idx, things)
         else:
-            if is_obstacle and ds[1] > 0:
-                self.theta[idx] -= pi / 2 - rand() * pi
-            else:
-                self.attraction[idx] += 0.0
+            ds = self.stencil_sectors(idx, things)
+        self.attraction[idx] += self.steer(m, ds)
+
+    @ti.func
+    def steer(self, m, ds):
+        # Turn towards the left (ds[0]) or right (ds[2]) reading when it is
+        # the strongest of the three.
+        turn = 0.0
+        if ds[0] > max(ds[1], ds[2]):
+            turn = min(self.sens[m] * (ds[0] - ds[2]), self.detect_a[m] / 2)
+        elif ds[2] > max(ds[1], ds[0]):
+            turn = -min(self.sens[m] * (ds[2] - ds[0]), self.detect_a[m] / 2)
+        return turn
+
+    @ti.func
+    def avoid_obstacle(self, idx, obstacle):
+        # Steer by the sector that contains the nearest obstacle, read from
+        # the obstacle distance field instead of a windowed scan.
+        m = self.member(idx)
+        center_index = ti.cast(self.pos[idx] * obstacle.size, ti.i32)
+        if obstacle.get_distance(m, center_index) < self.detect_r[m]:
+            toward = -obstacle.gradient(m, center_index)
+            if toward.norm() > 0:
+                sector = self.get_sector(toward, self.theta[idx], m)
+                if sector == 0:
+                    self.attraction[idx] = -0.3
+                elif sector == 2:
+                    self.attraction[idx] = 0.3
+                elif sector == 1:
+                    self.theta[idx] -= pi / 2 - self.random(idx, 7) * pi
 
     @ti.func
     def nearest_angle(self, idx, things):
+        m = self.member(idx)
         center_index = ti.cast(self.pos[idx] * things.size, ti.i32)
         angle = self.theta[idx]
         nearest_pos = ti.Vector([100, 100], ti.i32)
-        for i in range(-self.detect_r[None], self.detect_r[None]):
-            for j in range(-self.detect_r[None], self.detect_r[None]):
+        r = ti.cast(self.detect_r[m], ti.i32)
+        for i in range(-r, r):
+            for j in range(-r, r):
                 vec = ti.Vector([i, j], ti.i32)
-                c_vec = vec + center_index
-                if things.density_map[c_vec] > 0:
+                c_vec = things.wrap(vec + center_index)
+                if things.read(m, c_vec) > 0:
                     if vec.norm() < nearest_pos.norm():
                         nearest_pos = vec
         if nearest_pos.norm() < 50.0:
             angle = self.get_angle(nearest_pos)
         return angle
 
+    @ti.func
+    def nearest_field_angle(self, idx, things):
+        m = self.member(idx)
+        center_index = ti.cast(self.pos[idx] * things.size, ti.i32)
+        angle = self.theta[idx]
+        vec = things.nearest_offset(m, center_index)
+        r = ti.cast(self.detect_r[m], ti.i32)
+        if -r <= vec[0] < r and -r <= vec[1] < r:
+            if things.read(m, things.wrap(center_index + vec)) > 0:
+                if vec.norm() < 50.0:
+                    angle = self.get_angle(vec)
+            else:
+                # The cached target was eaten since the last rebuild.
+                angle = self.nearest_angle(idx, things)
+        return angle
+
     @ti.kernel
     def detect(self, home_pos: ti.template(), home_radius: ti.f32,
                food: ti.template(), obstacle: ti.template(), size: ti.f32):
-        for i in range(self.N):
-            self.attraction[i] = 0.0
-            if (home_pos[0] - self.pos[i]).norm() <= home_radius:
-                self.internal_clock[i] = self.clock_max
-                if self.is_home[i] == 1:
-                    self.is_home[i] = 0
-                    self.theta[i] += pi
-            elif (home_pos[0] - self.pos[i]).norm(
-            ) <= home_radius + self.detect_r[None] / size and self.is_home[
-                    i] == 1:
-                self.theta[i] = self.get_angle(home_pos[0] - self.pos[i])
-            if self.is_home[i] == 1:
-                self.detect_things(i, self.from_home)
-            else:
-                self.detect_things(i, self.from_food)
-                c = ti.cast(self.pos[i] * food.size, ti.i32)
-                if food.density_map[c] > 0:
-                    food.minus(c)
-                    self.is_home[i] = 1
-                    self.theta[i] += pi
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                m = self.member(i)
+                self.attraction[i] = 0.0
+                if ti.static(self.deterministic):
+                    self.took[i] = 0
+                if (home_pos[m] - self.pos[i]).norm() <= home_radius:
                     self.internal_clock[i] = self.clock_max
+                    if self.is_home[i] == 1:
+                        self.is_home[i] = 0
+                        self.theta[i] += pi
+                        ti.atomic_add(self.delivered[m], 1)
+                        if ti.static(self.spawn_per_food > 0):
+                            ti.atomic_add(self.births[m],
+                                          self.spawn_per_food)
+                elif (home_pos[m] - self.pos[i]).norm(
+                ) <= home_radius + self.detect_r[m] / size and self.is_home[
+                        i] == 1:
+                    self.theta[i] = self.get_angle(home_pos[m] - self.pos[i])
+                if self.is_home[i] == 1:
+                    self.detect_things(i, self.from_home)
                 else:
-                    self.theta[i] = self.nearest_angle(i, food)
-            self.detect_things(i, obstacle, True)
+                    self.detect_things(i, self.from_food)
+                    c = food.wrap(ti.cast(self.pos[i] * food.size, ti.i32))
+                    if food.read(m, c) > 0:
+                        if ti.static(self.deterministic):
+                            # Picked up in take_food.
+                            self.took[i] = 1
+                        else:
+                            food.minus(m, c)
+                            self.is_home[i] = 1
+                            self.theta[i] += pi
+                            self.internal_clock[i] = self.clock_max
+                    else:
+                        if ti.static(food.nearest_field):
+                            self.theta[i] = self.nearest_field_angle(i, food)
+                        else:
+                            self.theta[i] = self.nearest_angle(i, food)
+                self.avoid_obstacle(i, obstacle)
 
     @ti.kernel
     def release_pheromone(self, size: ti.i32):
-        for i in self.pos:
-            int_pos = ti.cast(self.pos[i] * size, dtype=ti.i32)
-            if self.is_home[i] == 1 and self.from_food.density_map[
-                    int_pos] < self.from_food.max_value:
-                self.from_food.density_map[
-                    int_pos] = self.from_food.single_value * self.internal_clock[
-                        i]
-                # self.from_food.set_area(int_pos, 1, self.internal_clock[i])
-            elif self.is_home[i] == 0 and self.from_home.density_map[
-                    int_pos] < self.from_home.max_value:
-                self.from_home.density_map[
-                    int_pos] = self.from_home.single_value * self.internal_clock[
-                        i]
-                # self.from_home.set_area(int_pos, 1, self.internal_clock[i])
-            if self.internal_clock[i] > 0.0:
-                self.internal_clock[i] -= self.clock_delta
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                m = self.member(i)
+                int_pos = ti.cast(self.pos[i] * size, dtype=ti.i32) % size
+                if ti.static(self.deterministic):
+                    if self.is_home[i] == 1:
+                        self.from_food.deposit(
+                            m, int_pos, self.from_food.single_value *
+                            self.internal_clock[i])
+                    else:
+                        self.from_home.deposit(
+                            m, int_pos, self.from_home.single_value *
+                            self.internal_clock[i])
+                elif self.is_home[i] == 1 and self.from_food.read(
+                        m, int_pos) < self.from_food.max_value:
+                    self.from_food.write(
+                        m, int_pos,
+                        self.from_food.single_value * self.internal_clock[i])
+                    # self.from_food.set_area(m, int_pos, 1,
+                    #                         self.internal_clock[i])
+                elif self.is_home[i] == 0 and self.from_home.read(
+                        m, int_pos) < self.from_home.max_value:
+                    self.from_home.write(
+                        m, int_pos,
+                        self.from_home.single_value * self.internal_clock[i])
+                    # self.from_home.set_area(m, int_pos, 1,
+                    #                         self.internal_clock[i])
+                if self.internal_clock[i] > 0.0:
+                    self.internal_clock[i] -= self.clock_d[m]
+                elif ti.static(self.starve):
+                    self.alive[i] = 0
+                    ti.atomic_sub(self.live[m], 1)
 
     @ti.func
     def get_angle(self, vec):
@@ -425,85 +2008,227 @@ class Ants:
 
     @ti.kernel
     def update_pos(self, obstacle: ti.template()):
-        for i in self.pos:
-            self.pos[i] += ti.Vector(
-                [ti.cos(self.theta[i]),
-                 ti.sin(self.theta[i])]) * self.speed
-            if obstacle.density_map[ti.cast(self.pos[i] * obstacle.size,
-                                            ti.i32)] != 0:
-                self.move_back(i)
-            if obstacle.density_map[ti.cast(self.pos[i] * obstacle.size,
-                                            ti.i32)] != 0:
-                self.pos[i] = [0, 0]
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                m = self.member(i)
+                if ti.static(self.deterministic):
+                    self.wash[i][0] = -1
+                self.pos[i] += ti.Vector(
+                    [ti.cos(self.theta[i]),
+                     ti.sin(self.theta[i])]) * self.speed
+                if obstacle.occupied(
+                        m, ti.cast(self.pos[i] * obstacle.size, ti.i32)):
+                    self.move_back(i, obstacle)
+                if obstacle.occupied(
+                        m, ti.cast(self.pos[i] * obstacle.size, ti.i32)):
+                    self.pos[i] = [0, 0]
 
     @ti.kernel
     def pbc(self):
-        for i in self.pos:
-            self.pos[i] -= ti.Vector([0.5, 0.5])
-            for d in ti.static(range(2)):
-                self.pos[i][d] -= round(self.pos[i][d])
-            self.pos[i] += ti.Vector([0.5, 0.5])
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                self.pos[i] -= ti.Vector([0.5, 0.5])
+                for d in ti.static(range(2)):
+                    self.pos[i][d] -= round(self.pos[i][d])
+                self.pos[i] += ti.Vector([0.5, 0.5])
+                # round() takes halves away from zero, which moves an ant at
+                # exactly 0, where update_pos parks those stuck in a wall, to
+                # 1.0: one cell past the edge of every map.
+                for d in ti.static(range(2)):
+                    if self.pos[i][d] >= 1.0:
+                        self.pos[i][d] = 0.0
 
     @ti.func
-    def move_back(self, idx):
+    def move_back(self, idx, obstacle):
+        m = self.member(idx)
         int_pos = ti.cast(self.pos[idx] * self.from_food.size, ti.i32)
-        self.from_food.wash_area(int_pos, 2)
-        self.from_home.wash_area(int_pos, 2)
         self.pos[idx] -= ti.Vector(
             [ti.cos(self.theta[idx]),
              ti.sin(self.theta[idx])]) * self.speed
         int_new_pos = ti.cast(self.pos[idx] * self.from_food.size, ti.i32)
-        self.from_food.wash_area(int_new_pos, 2)
-        self.from_home.wash_area(int_new_pos, 2)
-        self.theta[idx] -= pi / 2 - rand() * pi
+        if ti.static(self.deterministic):
+            self.wash[idx] = ti.Vector(
+                [int_pos[0], int_pos[1], int_new_pos[0], int_new_pos[1]])
+        else:
+            self.wash_cells(m, int_pos, int_new_pos)
+        away = obstacle.gradient(
+            m, ti.cast(self.pos[idx] * obstacle.size, ti.i32))
+        if away.norm() > 0:
+            self.theta[idx] = self.get_angle(away) + (self.random(idx, 8) -
+                                                      0.5) * pi
+        else:
+            self.theta[idx] -= pi / 2 - self.random(idx, 8) * pi
+
+    @ti.func
+    def wash_cells(self, m, a, b):
+        self.from_food.wash_area(m, a, 2)
+        self.from_home.wash_area(m, a, 2)
+        self.from_food.wash_area(m, b, 2)
+        self.from_home.wash_area(m, b, 2)
+
+    @ti.kernel
+    def apply_washes(self):
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                w = self.wash[i]
+                if w[0] >= 0:
+                    self.wash_cells(self.member(i), ti.Vector([w[0], w[1]]),
+                                    ti.Vector([w[2], w[3]]))
+
+    @ti.kernel
+    def take_food(self, food: ti.template()):
+        # Ants reaching food in detect pick it up here, one at a time in
+        # slot order, so which of them get the last units is reproducible.
+        ti.loop_config(serialize=True)
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                if self.took[i] == 1:
+                    m = self.member(i)
+                    c = food.wrap(ti.cast(self.pos[i] * food.size, ti.i32))
+                    if food.read(m, c) > 0:
+                        food.minus(m, c)
+                        self.is_home[i] = 1
+                        self.theta[i] += pi
+                        self.internal_clock[i] = self.clock_max
+
+    def update_sat(self):
+        if self.sat_mode[None] == 1:
+            for things in (self.from_home, self.from_food):
+                if things.summed_area:
+                    things.build_sat()
 
     def move(self, home_pos, home_r, food, size, obstacle):
-        self.detect(home_pos, home_r, food, obstacle, size)
-        self.random_ori()
-        self.update_pos(obstacle)
-        self.pbc()
+        with self.metrics.timed("sensing_setup"):
+            self.update_stencil()
+            self.update_sat()
+        with self.metrics.timed("detect"):
+            self.detect(home_pos, home_r, food, obstacle, size)
+            if self.deterministic:
+                self.take_food(food)
+        with self.metrics.timed("random_ori"):
+            self.random_ori()
+        with self.metrics.timed("update_pos"):
+            self.update_pos(obstacle)
+            if self.deterministic:
+                self.apply_washes()
+        with self.metrics.timed("pbc"):
+            self.pbc()
 
     @ti.kernel
     def slime_detect(self):
-        for i in range(self.N):
-            self.attraction[i] = 0.0
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                self.attraction[i] = 0.0
+                if self.is_home[i] == 1:
+                    self.detect_things(i, self.from_home)
+                else:
+                    self.detect_things(i, self.from_food)
+
+    @ti.func
+    def slime_advance(self, i):
+        self.pos[i] += ti.Vector([ti.cos(self.theta[i]),
+                                  ti.sin(self.theta[i])]) * self.speed
+        for d in ti.static(range(2)):
+            if self.pos[i][d] < 0:  # Bottom and left
+                self.pos[i][d] = 0  # move particle inside
+                self.theta[i] *= -1  # stop it from moving further
+
+            if self.pos[i][d] > 1:  # Top and right
+                self.pos[i][d] = 1  # move particle inside
+                self.theta[i] *= -1  # stop it from moving further
+
+    @ti.func
+    def slime_deposit(self, i, size):
+        m = self.member(i)
+        int_pos = ti.cast(self.pos[i] * size, dtype=ti.i32) % size
+        if ti.static(self.deterministic):
             if self.is_home[i] == 1:
-                self.detect_things(i, self.from_home)
+                self.from_food.deposit(m, int_pos, self.from_food.single_value)
             else:
-                self.detect_things(i, self.from_food)
+                self.from_home.deposit(m, int_pos, self.from_home.single_value)
+        elif self.is_home[i] == 1 and self.from_food.read(
+                m, int_pos) < self.from_food.max_value:
+            self.from_food.write(m, int_pos, self.from_food.single_value)
+        elif self.is_home[i] == 0 and self.from_home.read(
+                m, int_pos) < self.from_home.max_value:
+            self.from_home.write(m, int_pos, self.from_home.single_value)
 
     @ti.kernel
     def slime_update(self):
-        for i in self.pos:
-            self.pos[i] += ti.Vector(
-                [ti.cos(self.theta[i]),
-                 ti.sin(self.theta[i])]) * self.speed
-            for d in ti.static(range(2)):
-                if self.pos[i][d] < 0:  # Bottom and left
-                    self.pos[i][d] = 0  # move particle inside
-                    self.theta[i] *= -1  # stop it from moving further
-
-                if self.pos[i][d] > 1:  # Top and right
-                    self.pos[i][d] = 1  # move particle inside
-                    self.theta[i] *= -1  # stop it from moving further
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                self.slime_advance(i)
 
     @ti.kernel
     def slime_release_p(self, size: ti.i32):
-        for i in self.pos:
-            int_pos = ti.cast(self.pos[i] * size, dtype=ti.i32)
-            if self.is_home[i] == 1 and self.from_food.density_map[
-                    int_pos] < self.from_food.max_value:
-                self.from_food.density_map[
-                    int_pos] = self.from_food.single_value
-            elif self.is_home[i] == 0 and self.from_home.density_map[
-                    int_pos] < self.from_home.max_value:
-                self.from_home.density_map[
-                    int_pos] = self.from_home.single_value
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                self.slime_deposit(i, size)
+
+    @ti.func
+    def sense(self, m, things, p):
+        # The map at p, in cells, from the nearest cell or interpolated
+        # between the four around it.
+        value = 0.0
+        if ti.static(self.slime_sensor == "bilinear"):
+            q = p - 0.5
+            base = ti.floor(q)
+            f = q - base
+            c = ti.cast(base, ti.i32)
+            v00 = things.read(m, things.wrap(c))
+            v10 = things.read(m, things.wrap(c + ti.Vector([1, 0])))
+            v01 = things.read(m, things.wrap(c + ti.Vector([0, 1])))
+            v11 = things.read(m, things.wrap(c + ti.Vector([1, 1])))
+            value = (v00 * (1 - f[0]) + v10 * f[0]) * (1 - f[1]) + (
+                v01 * (1 - f[0]) + v11 * f[0]) * f[1]
+        else:
+            value = things.read(m,
+                                things.wrap(ti.cast(ti.floor(p), ti.i32)))
+        return value
+
+    @ti.kernel
+    def slime_step(self, release: ti.i32, size: ti.i32):
+        # Agents deposit while others are still sensing, so a step may see
+        # part of its own deposits, as in the usual Physarum models.
+        # Deterministic runs deposit in slime_release_p afterwards.
+        for k in range(self.members * self.span[None]):
+            i = self.slot(k)
+            if i >= 0:
+                m = self.member(i)
+                p = self.pos[i] * self.from_home.size
+                ds = ti.Vector([0.0, 0.0, 0.0], ti.f32)
+                for s in ti.static(range(3)):
+                    angle = self.theta[i] + (1 - s) * self.detect_a[m]
+                    tap = p + self.detect_r[m] * ti.Vector(
+                        [ti.cos(angle), ti.sin(angle)])
+                    if self.is_home[i] == 1:
+                        ds[s] = self.sense(m, self.from_home, tap)
+                    else:
+                        ds[s] = self.sense(m, self.from_food, tap)
+                self.attraction[i] = self.steer(m, ds)
+                self.theta[i] += ((self.random(i, 6) - 0.5) * 2.0 *
+                                  self.omgm[m] + self.attraction[i])
+                self.slime_advance(i)
+                if release and not ti.static(self.deterministic):
+                    self.slime_deposit(i, size)
 
     def slime_move(self):
-        self.slime_detect()
-        self.random_ori()
-        self.slime_update()
+        with self.metrics.timed("sensing_setup"):
+            self.update_stencil()
+            self.update_sat()
+        with self.metrics.timed("detect"):
+            self.slime_detect()
+        with self.metrics.timed("random_ori"):
+            self.random_ori()
+        with self.metrics.timed("update_pos"):
+            self.slime_update()
         # self.pbc()
 
     def get_ants(self):
@@ -517,66 +2242,890 @@ class Detectables:
                  decay_rate,
                  single_value,
                  max_value,
-                 brush_size=None):
+                 brush_size=None,
+                 summed_area=False,
+                 nearest_field=False,
+                 tile_size=16,
+                 lazy_decay=False,
+                 evaporation="linear",
+                 members=1,
+                 storage="f32",
+                 quantum=None,
+                 sparse=False,
+                 diffuse_radius=0,
+                 diffuse_kernel="box",
+                 diffuse_rate=1.0,
+                 deterministic=False):
         self.init_decay_rate = decay_rate
         self.max_value = max_value
         self.single_value = single_value
         self.canvas = canvas
         self.size = self.canvas.size
-        self.density_map = ti.field(dtype=ti.f32,
-                                    shape=(canvas.size, canvas.size))
+        self.members = members
+        # Cells may be stored as f16, or as u8/u16 multiples of `quantum`
+        # (fixed point, by default spanning 0..max_value). Integer stores
+        # round stochastically, so per-step decays far below one quantum
+        # still evaporate at the right rate on average.
+        self.storage = storage
+        self.dtype = {
+            "f32": ti.f32,
+            "f16": ti.f16,
+            "u16": ti.u16,
+            "u8": ti.u8
+        }[storage]
+        self.storage_dtype = {
+            "f32": np.float32,
+            "f16": np.float16,
+            "u16": np.uint16,
+            "u8": np.uint8
+        }[storage]
+        self.quantized = storage in ("u8", "u16")
+        self.levels = {"u8": 255, "u16": 65535}.get(storage, 0)
+        if quantum is None:
+            quantum = max_value / self.levels if self.quantized else 1.0
+        self.quantum = quantum
+        # A sparse map allocates its cells per tile, on the first non-zero
+        # write, and frees tiles again once they decay to zero, so memory
+        # follows the trails rather than the world area.
+        self.sparse = sparse
+        self.tile_size = tile_size
+        tiles = (canvas.size + tile_size - 1) // tile_size
+        self.block = None
+        if sparse:
+            if summed_area:
+                raise ValueError("summed-area tables need a dense map")
+            if canvas.size % tile_size != 0:
+                raise ValueError(
+                    "sparse maps need a size divisible by the tile size")
+            self.density_map = ti.field(dtype=self.dtype)
+            self.block = ti.root.pointer(ti.ijk, (members, tiles, tiles))
+            cells = self.block.dense(ti.ijk, (1, tile_size, tile_size))
+            cells.place(self.density_map)
+        else:
+            self.density_map = ti.field(dtype=self.dtype,
+                                        shape=(members, canvas.size,
+                                               canvas.size))
         self.init_brush_size = brush_size
         self.brush_size = ti.field(dtype=ti.f32, shape=())
-        self.decay_rate = ti.field(dtype=ti.f32, shape=())
+        self.decay_rate = ti.field(dtype=ti.f32, shape=members)
+        # Tiles holding any non-zero cell. Writes activate them, decay
+        # visits only active tiles and retires the ones that reach zero.
+        self.tiles = ti.field(dtype=ti.i32, shape=(members, tiles, tiles))
+        # The active tiles of a decay, compacted so its threads cover only
+        # their cells.
+        self.active = ti.Vector.field(3,
+                                      dtype=ti.i32,
+                                      shape=members * tiles * tiles)
+        self.n_active = ti.field(dtype=ti.i32, shape=())
+        # Lazy evaporation: decay() only advances the clock, and each read
+        # applies the evaporation accumulated since the cell's last write.
+        self.lazy_decay = lazy_decay
+        self.evaporation = evaporation
+        self.clock = ti.field(dtype=ti.i32, shape=())
+        self.stamp = None
+        if lazy_decay and sparse:
+            self.stamp = ti.field(dtype=ti.i32)
+            cells.place(self.stamp)
+        elif lazy_decay:
+            self.stamp = ti.field(dtype=ti.i32,
+                                  shape=(members, canvas.size, canvas.size))
+        # Diffusion: decay() first blurs the map with a separable box or
+        # Gaussian filter of the given radius, mixing in diffuse_rate of
+        # the blurred value, in two sweeps through a ping-pong buffer that
+        # also evaporate and re-flag tiles.
+        self.diffuse_radius = diffuse_radius
+        self.init_diffuse_rate = diffuse_rate
+        self.diffuse_rate = ti.field(dtype=ti.f32, shape=members)
+        if diffuse_radius and (sparse or lazy_decay):
+            raise ValueError("diffusion needs a dense, eagerly decayed map")
+        radius = max(diffuse_radius, 1)
+        offsets = np.arange(-radius, radius + 1)
+        if diffuse_kernel == "gaussian":
+            weights = np.exp(-offsets**2 / (2 * (radius / 2)**2))
+        elif diffuse_kernel == "box":
+            weights = np.ones(len(offsets))
+        else:
+            raise ValueError("unknown diffusion kernel " + diffuse_kernel)
+        self.diffuse_weights = tuple(float(w) for w in weights / weights.sum())
+        self.buffer = None
+        if diffuse_radius:
+            self.buffer = ti.field(dtype=ti.f32,
+                                   shape=(members, canvas.size, canvas.size))
+        self.summed_area = summed_area
+        self.sat = None
+        if summed_area:
+            self.sat = ti.field(dtype=ti.f64,
+                                shape=(members, canvas.size + 1,
+                                       canvas.size + 1))
+        # Cached nearest-occupied-cell field. Painting rebuilds it at once;
+        # cells removed by minus() only leave stale targets behind, which
+        # readers detect, so those rebuilds are batched every flood_interval
+        # steps.
+        self.nearest_field = nearest_field
+        self.flood = None
+        self.offsets = None
+        self.offset_block = None
+        if nearest_field:
+            # Ants only steer towards food within 50 cells.
+            # A sparse world's flood is always transient; see JumpFlood.
+            self.flood = JumpFlood(canvas.size,
+                                   members,
+                                   max_range=64,
+                                   tile_size=tile_size,
+                                   transient=True if sparse else None)
+            # Only the offset from each cell to its target is read between
+            # rebuilds, in i8; see nearest_offset.
+            if sparse:
+                self.offsets = ti.Vector.field(2, dtype=ti.i8)
+                self.offset_block = ti.root.pointer(ti.ijk,
+                                                    (members, tiles, tiles))
+                self.offset_block.dense(ti.ijk,
+                                        (1, tile_size, tile_size)).place(
+                                            self.offsets)
+            else:
+                self.offsets = ti.Vector.field(2,
+                                               dtype=ti.i8,
+                                               shape=(members, canvas.size,
+                                                      canvas.size))
+        self.flood_interval = 16
+        self.flood_version = -1
+        self.flood_removed = 0
+        self.flood_age = 0
+        # version counts host-side edits, removed counts minus() calls.
+        self.version = 0
+        self.removed = ti.field(dtype=ti.i32, shape=())
+        # Deterministic maps round with noise hashed from the seed, cell,
+        # step and value instead of ti.random().
+        self.deterministic = deterministic
+        if deterministic and lazy_decay:
+            raise ValueError("deterministic maps cannot decay lazily")
+        self.seed = ti.field(dtype=ti.u32, shape=())
+        self.tick = ti.field(dtype=ti.i32, shape=())
 
     def init_brush(self):
         self.brush_size[None] = self.init_brush_size
 
     @ti.func
-    def minus(self, pos):
-        if self.density_map[pos] > 0:
-            self.density_map[pos] -= 1
+    def wrap(self, pos):
+        return pos % self.size
+
+    @ti.func
+    def evaporate(self, m, value, steps):
+        if ti.static(self.evaporation == "exponential"):
+            value *= (1 - self.decay_rate[m])**steps
+        elif steps > 0:
+            # Closed form of decay() applied `steps` times: subtract while
+            # positive, clamp to zero on the step after crossing it.
+            if value - (steps - 1) * self.decay_rate[m] > 0:
+                value -= steps * self.decay_rate[m]
+            else:
+                value = 0.0
+        return value
+
+    @ti.func
+    def load(self, m, i, j):
+        value = ti.cast(self.density_map[m, i, j], ti.f32)
+        if ti.static(self.quantized):
+            value *= self.quantum
+        return value
+
+    @ti.func
+    def noise(self, m, i, j, value):
+        u = 0.0
+        if ti.static(self.deterministic):
+            u = counter_random(self.seed[None],
+                               (m * self.size + i) * self.size + j,
+                               self.tick[None], ti.bit_cast(value, ti.i32))
+        else:
+            u = ti.random()
+        return u
+
+    @ti.func
+    def encode(self, m, i, j, value):
+        stored = ti.cast(0, self.dtype)
+        if ti.static(self.quantized):
+            u = self.noise(m, i, j, value)
+            q = min(max(ti.floor(value / self.quantum + u), 0.0),
+                    self.levels)
+            stored = ti.cast(q, self.dtype)
+        else:
+            if ti.static(self.storage == "f16"):
+                # Round to one of the two neighbouring halves. Their spacing
+                # is 2^(exponent - 10), fixed below the smallest normal 2^-14
+                # (biased f32 exponent 113).
+                e = max((ti.bit_cast(value, ti.i32) >> 23) & 0xFF, 113)
+                ulp = ti.bit_cast((e - 10) << 23, ti.f32)
+                u = self.noise(m, i, j, value)
+                value = ti.floor(value / ulp + u) * ulp
+            stored = ti.cast(value, self.dtype)
+        return stored
+
+    @ti.func
+    def store(self, m, i, j, value):
+        self.density_map[m, i, j] = self.encode(m, i, j, value)
+
+    @ti.func
+    def read(self, m, pos):
+        value = self.load(m, pos[0], pos[1])
+        if ti.static(self.lazy_decay):
+            value = self.evaporate(
+                m, value, self.clock[None] - self.stamp[m, pos[0], pos[1]])
+        return value
+
+    @ti.func
+    def write(self, m, pos, value):
+        t = pos // self.tile_size
+        skip = False
+        if ti.static(self.sparse):
+            # Zeros need no storage, so they never allocate a tile.
+            skip = value == 0 and ti.is_active(self.block, [m, t[0], t[1]
+                                                            ]) == 0
+        if not skip:
+            self.store(m, pos[0], pos[1], value)
+            if ti.static(self.lazy_decay):
+                self.stamp[m, pos[0], pos[1]] = self.clock[None]
+            if value != 0:
+                self.tiles[m, t[0], t[1]] = 1
+
+    @ti.func
+    def minus(self, m, pos):
+        value = self.read(m, pos)
+        if value > 0:
+            self.write(m, pos, value - 1)
+            ti.atomic_add(self.removed[None], 1)
+
+    @ti.func
+    def deposit(self, m, pos, value):
+        # Raises the cell to value, so concurrent deposits leave the same
+        # result in any order.
+        t = pos // self.tile_size
+        ti.atomic_max(self.density_map[m, pos[0], pos[1]],
+                      self.encode(m, pos[0], pos[1], value))
+        if value != 0:
+            self.tiles[m, t[0], t[1]] = 1
+
+    @ti.func
+    def occupied(self, m, pos):
+        return self.read(m, pos) > 0
 
     @ti.kernel
+    def init_map(self):
+        for m, i, j in self.density_map:
+            self.density_map[m, i, j] = ti.cast(0, self.dtype)
+        for m, i, j in self.tiles:
+            self.tiles[m, i, j] = 0
+        if ti.static(self.lazy_decay):
+            self.clock[None] = 0
+            for m, i, j in self.stamp:
+                self.stamp[m, i, j] = 0
+
+    @ti.kernel
+    def set_rates(self, values: ti.types.ndarray()):
+        for m in self.decay_rate:
+            self.decay_rate[m] = values[0, m]
+            self.diffuse_rate[m] = values[1, m]
+
     def init(self):
-        self.decay_rate[None] = self.init_decay_rate
-        for i, j in self.density_map:
-            self.density_map[i, j] = 0.0
+        self.set_rates(
+            np.stack([
+                per_member(self.init_decay_rate, self.members),
+                per_member(self.init_diffuse_rate, self.members)
+            ]))
+        self.init_map()
+        if self.sparse:
+            self.block.deactivate_all()
+        self.version += 1
+
+    def state_names(self):
+        names = ["density_map", "decay_rate", "seed"]
+        if self.lazy_decay:
+            names += ["stamp", "clock"]
+        if self.diffuse_radius:
+            names += ["diffuse_rate"]
+        return names
+
+    def state(self):
+        return get_fields(self, self.state_names())
+
+    def load_state(self, state):
+        values = np.asarray(state["density_map"])
+        check_shape("density_map", values, self.density_map.shape)
+        stamps = values
+        if self.lazy_decay:
+            stamps = np.asarray(state["stamp"])
+            check_shape("stamp", stamps, self.stamp.shape)
+        self.import_map(
+            np.asarray(values, dtype=self.storage_dtype, order="C"),
+            np.asarray(stamps, order="C"))
+        set_fields(self, state, [
+            name for name in self.state_names()
+            if name not in ("density_map", "stamp")
+        ])
+
+    def from_numpy(self, values):
+        # Replaces the whole map, given in the units of to_numpy, in one
+        # transfer. A single map is copied to every member.
+        values = np.asarray(values, dtype=np.float32)
+        if self.quantized:
+            # Rounds to the nearest level; the maps hold no negatives.
+            values = np.clip(values / self.quantum + 0.5, 0, self.levels)
+        values = np.ascontiguousarray(
+            np.broadcast_to(values.astype(self.storage_dtype),
+                            self.density_map.shape))
+        stamps = values
+        if self.lazy_decay:
+            stamps = np.full(values.shape, self.clock[None], dtype=np.int32)
+        self.import_map(values, stamps)
+
+    def import_map(self, values, stamps):
+        if self.sparse:
+            # from_numpy skips unallocated tiles, so the non-zero cells are
+            # written one by one instead.
+            self.block.deactivate_all()
+            self.import_cells(values, stamps)
+        else:
+            self.density_map.from_numpy(values)
+            if self.lazy_decay:
+                self.stamp.from_numpy(stamps)
+        self.update_tiles()
+        self.version += 1
 
     @ti.kernel
+    def store_offsets(self):
+        # (0, 0) means no target in range, so unallocated tiles of a sparse
+        # map read as none; a seed's own zero offset is stored as -128.
+        if ti.static(not self.sparse):
+            for m, i, j in self.offsets:
+                self.offsets[m, i, j] = ti.Vector([0, 0], ti.i8)
+        # Only the tiles the flood covered can have a target.
+        for m, ti_, tj in self.flood.mask:
+            if self.flood.mask[m, ti_, tj] == 1:
+                for u, v in ti.ndrange(self.tile_size, self.tile_size):
+                    i = ti_ * self.tile_size + u
+                    j = tj * self.tile_size + v
+                    if i < self.size and j < self.size:
+                        d = self.flood.offset(m, ti.Vector([i, j]))
+                        if abs(d[0]) <= 127 and abs(d[1]) <= 127:
+                            if d[0] == 0 and d[1] == 0:
+                                d = ti.Vector([-128, -128])
+                            self.offsets[m, i, j] = ti.cast(d, ti.i8)
+
+    @ti.func
+    def nearest_offset(self, m, pos):
+        # Offset to the nearest occupied cell as of the last rebuild, or
+        # (size, size) if none was within the flood's range.
+        p = self.wrap(pos)
+        stored = ti.cast(self.offsets[m, p[0], p[1]], ti.i32)
+        d = ti.Vector([self.size, self.size], ti.i32)
+        if stored[0] == -128:
+            d = ti.Vector([0, 0], ti.i32)
+        elif stored[0] != 0 or stored[1] != 0:
+            d = stored
+        return d
+
+    def update_nearest(self):
+        if not self.nearest_field:
+            return
+        self.flood_age += 1
+        removed = self.removed[None]
+        if self.flood_version != self.version or (
+                self.flood_age >= self.flood_interval
+                and self.flood_removed != removed):
+            self.flood.run(self, self.density_map)
+            if self.sparse:
+                self.offset_block.deactivate_all()
+            self.store_offsets()
+            self.flood.release()
+            self.flood_version = self.version
+            self.flood_removed = removed
+            self.flood_age = 0
+
+    def changes(self):
+        return self.version, self.removed[None]
+
     def decay(self):
-        for i, j in self.density_map:
-            if self.density_map[i, j] > 0:
-                self.density_map[i, j] -= self.decay_rate[None]
-            elif self.density_map[i, j] < 0:
-                self.density_map[i, j] = 0
+        if self.lazy_decay:
+            self.clock[None] += 1
+        elif self.diffuse_radius:
+            self.diffuse_rows()
+            self.diffuse_columns(1, False)
+        else:
+            self.decay_tiles()
+
+    @ti.kernel
+    def decay_tiles(self):
+        # A thread per cell of the active tiles: they are listed and marked
+        # 2 first, cells still non-zero after decaying mark theirs 1 again,
+        # and the tiles left at 2 are retired.
+        self.n_active[None] = 0
+        for m, ti_, tj in self.tiles:
+            if self.tiles[m, ti_, tj] == 1:
+                self.tiles[m, ti_, tj] = 2
+                self.active[ti.atomic_add(self.n_active[None], 1)] = [
+                    m, ti_, tj
+                ]
+        for k, u in ti.ndrange(self.n_active[None], self.tile_size):
+            tile = self.active[k]
+            m = tile[0]
+            i = tile[1] * self.tile_size + u
+            active = 0
+            for v in range(self.tile_size):
+                j = tile[2] * self.tile_size + v
+                if i < self.size and j < self.size:
+                    self.store(m, i, j,
+                               self.evaporate(m, self.load(m, i, j), 1))
+                    if self.density_map[m, i, j] != 0:
+                        active = 1
+            if active:
+                self.tiles[tile] = 1
+        for k in range(self.n_active[None]):
+            tile = self.active[k]
+            if self.tiles[tile] == 2:
+                self.tiles[tile] = 0
+                if ti.static(self.sparse):
+                    ti.deactivate(self.block, tile)
+
+    @ti.kernel
+    def import_cells(self, values: ti.types.ndarray(),
+                     stamps: ti.types.ndarray()):
+        for m, i, j in ti.ndrange(self.members, self.size, self.size):
+            if values[m, i, j] != 0:
+                self.density_map[m, i, j] = values[m, i, j]
+                if ti.static(self.lazy_decay):
+                    self.stamp[m, i, j] = stamps[m, i, j]
+
+    @ti.kernel
+    def bake(self):
+        for m, i, j in self.density_map:
+            p = ti.Vector([i, j])
+            self.write(m, p, self.read(m, p))
+
+    def to_numpy(self):
+        if self.lazy_decay:
+            self.bake()
+        values = self.density_map.to_numpy()
+        if self.storage == "f32":
+            return values
+        return values.astype(np.float32) * np.float32(self.quantum)
 
     @ti.kernel
-    def draw(self, pos: ti.template(), value: ti.i32):
+    def update_tiles(self):
+        for m, ti_, tj in self.tiles:
+            self.tiles[m, ti_, tj] = 0
+        for m, i, j in self.density_map:
+            if self.density_map[m, i, j] != 0:
+                self.tiles[m, i // self.tile_size, j // self.tile_size] = 1
+
+    def draw(self, pos, value):
+        self.draw_brush(pos, value)
+        self.version += 1
+
+    @ti.kernel
+    def draw_brush(self, pos: vec2, value: ti.i32):
         center = ti.cast(pos * self.size, ti.i32)
         size = ti.cast(self.brush_size[None], ti.i32)
-        for i in range(-size, size):
-            for j in range(-size, size):
-                if ti.Vector([i, j]).norm() <= self.brush_size[None]:
-                    self.density_map[center + (i, j)] = value
+        for m, i, j in ti.ndrange(self.members, (-size, size), (-size, size)):
+            if ti.Vector([i, j]).norm() <= self.brush_size[None]:
+                self.write(m, self.wrap(center + ti.Vector([i, j])), value)
 
     @ti.func
-    def set_area(self, center, radius, rate):
+    def set_area(self, m, center, radius, rate):
         for i in range(center[0] - radius, center[0] + radius):
             for j in range(center[1] - radius, center[1] + radius):
-                self.density_map[i, j] += self.single_value * rate
+                p = self.wrap(ti.Vector([i, j]))
+                self.write(m, p, self.read(m, p) + self.single_value * rate)
 
     @ti.func
-    def wash_area(self, center, radius):
+    def wash_area(self, m, center, radius):
         for i in range(center[0] - radius, center[0] + radius):
             for j in range(center[1] - radius, center[1] + radius):
-                self.density_map[i, j] = 0.0
+                self.write(m, self.wrap(ti.Vector([i, j])), 0.0)
+
+    @ti.kernel
+    def build_sat(self):
+        for m, i in ti.ndrange(self.members, self.size + 1):
+            self.sat[m, i, 0] = 0.0
+            self.sat[m, 0, i] = 0.0
+        for m, i in ti.ndrange(self.members, self.size):
+            acc = ti.cast(0.0, ti.f64)
+            for j in range(self.size):
+                acc += self.read(m, ti.Vector([i, j]))
+                self.sat[m, i + 1, j + 1] = acc
+        for m, j in ti.ndrange(self.members, self.size):
+            for i in range(self.size):
+                self.sat[m, i + 1, j + 1] += self.sat[m, i, j + 1]
+
+    @ti.func
+    def box_sum(self, m, lo, hi):
+        total = 0.0
+        if hi[0] > lo[0] and hi[1] > lo[1]:
+            total = ti.cast(
+                self.sat[m, hi[0], hi[1]] - self.sat[m, lo[0], hi[1]] -
+                self.sat[m, hi[0], lo[1]] + self.sat[m, lo[0], lo[1]], ti.f32)
+        return total
+
+    @ti.func
+    def wrap_index(self, i):
+        if i < 0:
+            i += self.size
+        elif i >= self.size:
+            i -= self.size
+        return i
+
+    # Both passes run a row per thread, walking its cells in memory order.
+    @ti.kernel
+    def diffuse_rows(self):
+        r = ti.static(len(self.diffuse_weights) // 2)
+        for m, i in ti.ndrange(self.members, self.size):
+            for j in range(self.size):
+                total = 0.0
+                for k in ti.static(range(-r, r + 1)):
+                    total += self.diffuse_weights[k + r] * self.load(
+                        m, self.wrap_index(i + k), j)
+                self.buffer[m, i, j] = total
 
     @ti.kernel
+    def diffuse_columns(self, steps: ti.i32, full: ti.i32):
+        r = ti.static(len(self.diffuse_weights) // 2)
+        for m, ti_, tj in self.tiles:
+            self.tiles[m, ti_, tj] = 0
+        for m, i in ti.ndrange(self.members, self.size):
+            for j in range(self.size):
+                total = 0.0
+                for k in ti.static(range(-r, r + 1)):
+                    total += self.diffuse_weights[k + r] * self.buffer[
+                        m, i, self.wrap_index(j + k)]
+                value = total
+                if not full:
+                    value = self.load(m, i, j)
+                    value += self.diffuse_rate[m] * (total - value)
+                self.store(m, i, j, self.evaporate(m, value, steps))
+                if self.density_map[m, i, j] != 0:
+                    self.tiles[m, i // self.tile_size,
+                               j // self.tile_size] = 1
+
     def blur(self):
-        for i, j in self.density_map:
-            self.density_map[
-                i,
-                j] = (self.density_map[i - 1, j] + self.density_map[i + 1, j] +
-                      self.density_map[i, j + 1] + self.density_map[i, j - 1] +
-                      self.density_map[i, j]) / 5
+        # One full pass of the diffusion filter (3x3 box if none is set),
+        # without evaporation.
+        if self.sparse:
+            raise ValueError("blurring needs a dense map")
+        if self.lazy_decay:
+            self.bake()
+        if self.buffer is None:
+            self.buffer = ti.field(dtype=ti.f32,
+                                   shape=(self.members, self.size, self.size))
+        self.diffuse_rows()
+        self.diffuse_columns(0, True)
+
+
+# Jump floods whose ping-pong buffers would take more bytes than this are
+# only allocated while they are rebuilt.
+TRANSIENT_FLOOD = 32 * 1024**2
+
+
+@ti.data_oriented
+class JumpFlood:
+    def __init__(self,
+                 size,
+                 members=1,
+                 max_range=None,
+                 tile_size=16,
+                 transient=None):
+        self.size = size
+        self.members = members
+        # Seeds are stored as cell + 1, so zero means none and a sparse
+        # field reads as empty wherever it is unallocated. i16 holds them
+        # for any grid that fits in memory and halves the two largest
+        # fields of a world.
+        self.dtype = ti.i16 if size < 2**15 - 1 else ti.i32
+        # Seeds further than max_range cells away may be missed, which
+        # saves the longest passes and lets the flood skip every tile that
+        # is further than that from any seed.
+        self.max_range = size if max_range is None else min(max_range, size)
+        self.tile_size = tile_size
+        tiles = (size + tile_size - 1) // tile_size
+        # The passes ping-pong between two copies of the seeds, the second
+        # stacked after the first along the member axis, so that a pass
+        # compiles once whichever way it runs. The result ends up in the
+        # first. Both are scratch, and owners release() the flood once they
+        # have copied out what they keep. A transient flood allocates its
+        # tiles, within max_range of a seed, only while a rebuild runs: at
+        # 4096² that saves 128 MB, but doubles the time of a rebuild at
+        # 512², where the buffers take 2 MB. So by default only floods
+        # whose buffers exceed TRANSIENT_FLOOD bytes are transient.
+        if transient is None:
+            transient = (2 * members * size * size * 2 *
+                         (2 if self.dtype == ti.i16 else 4) > TRANSIENT_FLOOD)
+        self.transient = transient
+        self.block = None
+        if transient:
+            self.nearest = ti.Vector.field(2, dtype=self.dtype)
+            self.block = ti.root.pointer(ti.ijk, (2 * members, tiles, tiles))
+            self.block.dense(ti.ijk,
+                             (1, tile_size, tile_size)).place(self.nearest)
+        else:
+            self.nearest = ti.Vector.field(2,
+                                           dtype=self.dtype,
+                                           shape=(2 * members, size, size))
+        # Tiles holding a seed, and those within max_range of one.
+        self.seeded = ti.field(dtype=ti.i32, shape=(members, tiles, tiles))
+        self.mask = ti.field(dtype=ti.i32, shape=(members, tiles, tiles))
+        self.tile_reach = self.max_range // tile_size + 1
+
+    @ti.func
+    def delta(self, pos, seed):
+        d = seed - pos
+        for e in ti.static(range(2)):
+            if d[e] > self.size // 2:
+                d[e] -= self.size
+            elif d[e] < -(self.size // 2):
+                d[e] += self.size
+        return d
+
+    @ti.func
+    def offset(self, m, pos):
+        # Out-of-range cells of a sparse field are not merely wrong but
+        # unmapped, so wrap as the maps do.
+        p = pos % self.size
+        seed = ti.cast(self.nearest[m, p[0], p[1]], ti.i32) - 1
+        d = ti.Vector([self.size, self.size], ti.i32)
+        if seed[0] >= 0:
+            d = self.delta(p, seed)
+        return d
+
+    @ti.kernel
+    def seed(self, things: ti.template(), cells: ti.template(),
+             invert: ti.template()):
+        for m, i, j in self.seeded:
+            self.seeded[m, i, j] = 0
+        for m, i, j in cells:
+            p = ti.Vector([i, j])
+            if things.occupied(m, p) != invert:
+                # The nearest occupied cell to any free one lies on the
+                # boundary, so interior cells need not seed the flood.
+                edge = False
+                for d in ti.static([(1, 0), (-1, 0), (0, 1), (0, -1)]):
+                    q = (p + ti.Vector(d)) % self.size
+                    if things.occupied(m, q) == invert:
+                        edge = True
+                if edge:
+                    self.nearest[m, i, j] = ti.cast(p + 1, self.dtype)
+                    self.seeded[m, i // self.tile_size,
+                                j // self.tile_size] = 1
+
+    @ti.kernel
+    def dilate(self, src: ti.template(), dst: ti.template(), axis: ti.i32):
+        tiles = self.mask.shape[1]
+        for m, i, j in dst:
+            hit = 0
+            for k in range(-self.tile_reach, self.tile_reach + 1):
+                if axis == 0:
+                    hit |= src[m, (i + k) % tiles, j]
+                else:
+                    hit |= src[m, i, (j + k) % tiles]
+            dst[m, i, j] = hit
+
+    @ti.kernel
+    def flood(self, half: ti.i32, k: ti.i32):
+        src = half * self.members
+        dst = (1 - half) * self.members
+        for m, ti_, tj in self.mask:
+            if self.mask[m, ti_, tj] == 1:
+                for u, v in ti.ndrange(self.tile_size, self.tile_size):
+                    i = ti_ * self.tile_size + u
+                    j = tj * self.tile_size + v
+                    if i < self.size and j < self.size:
+                        p = ti.Vector([i, j])
+                        best = ti.cast(self.nearest[src + m, i, j], ti.i32)
+                        best_d = self.size * self.size * 2
+                        if best[0] > 0:
+                            best_d = self.delta(p, best - 1).norm_sqr()
+                        for dx, dy in ti.static(ti.ndrange((-1, 2), (-1, 2))):
+                            q = (p + ti.Vector([dx, dy]) * k) % self.size
+                            candidate = ti.cast(
+                                self.nearest[src + m, q[0], q[1]], ti.i32)
+                            if candidate[0] > 0:
+                                d = self.delta(p, candidate - 1).norm_sqr()
+                                if d < best_d:
+                                    best_d = d
+                                    best = candidate
+                        # A cell keeps its seed once it has one, so cells
+                        # still without one need no write.
+                        if best[0] > 0:
+                            self.nearest[dst + m, i, j] = ti.cast(
+                                best, self.dtype)
+
+    @ti.kernel
+    def clear_tiles(self):
+        # Passes write only inside the mask, so a resident flood is clean
+        # again once the last rebuild's tiles are.
+        for m, ti_, tj in self.mask:
+            if self.mask[m, ti_, tj] == 1:
+                for h, u, v in ti.ndrange(2, self.tile_size, self.tile_size):
+                    i = ti_ * self.tile_size + u
+                    j = tj * self.tile_size + v
+                    if i < self.size and j < self.size:
+                        self.nearest[h * self.members + m, i, j] = ti.cast(
+                            ti.Vector([0, 0]), self.dtype)
+
+    def clear(self):
+        if self.transient:
+            self.block.deactivate_all()
+        else:
+            self.clear_tiles()
+
+    def release(self):
+        if self.transient:
+            self.block.deactivate_all()
+
+    def run(self, things, cells, invert=False):
+        self.clear()
+        self.seed(things, cells, invert)
+        self.dilate(self.seeded, self.mask, 0)
+        self.dilate(self.mask, self.seeded, 1)
+        self.mask.copy_from(self.seeded)
+        steps = []
+        k = 1
+        while k < self.max_range:
+            steps.insert(0, k)
+            k *= 2
+        steps.append(1)
+        if len(steps) % 2 == 1:
+            steps.append(1)
+        for n, k in enumerate(steps):
+            self.flood(n % 2, k)
+
+
+@ti.data_oriented
+class Obstacles:
+    def __init__(self, canvas, brush_size=None, members=1):
+        self.canvas = canvas
+        self.size = canvas.size
+        self.members = members
+        # One bit per cell, 32 cells of a row per word.
+        self.words = (self.size + 31) // 32
+        self.bits = ti.field(dtype=ti.u32,
+                             shape=(members, self.size, self.words))
+        # Signed distance to the obstacle boundary in cells, negative inside
+        # obstacles and clamped to the i8 range.
+        self.distance = ti.field(dtype=ti.i8,
+                                 shape=(members, self.size, self.size))
+        # Distances saturate at 127 cells, so neither flood needs to reach
+        # further.
+        self.flood = JumpFlood(self.size, members, max_range=128)
+        self.init_brush_size = brush_size
+        self.brush_size = ti.field(dtype=ti.f32, shape=())
+        self.version = 0
+        self.distance_version = -1
+
+    def init_brush(self):
+        self.brush_size[None] = self.init_brush_size
+
+    @ti.func
+    def wrap(self, pos):
+        return pos % self.size
+
+    @ti.func
+    def occupied(self, m, pos):
+        p = self.wrap(pos)
+        word = self.bits[m, p[0], p[1] // 32]
+        return (word >> ti.cast(p[1] % 32, ti.u32)) & 1 != 0
+
+    @ti.func
+    def set(self, m, pos, value):
+        p = self.wrap(pos)
+        mask = ti.u32(1) << ti.cast(p[1] % 32, ti.u32)
+        if value != 0:
+            ti.atomic_or(self.bits[m, p[0], p[1] // 32], mask)
+        else:
+            ti.atomic_and(self.bits[m, p[0], p[1] // 32], ~mask)
+
+    @ti.func
+    def get_distance(self, m, pos):
+        p = self.wrap(pos)
+        return ti.cast(self.distance[m, p[0], p[1]], ti.f32)
+
+    @ti.func
+    def gradient(self, m, pos):
+        # Points away from the nearest obstacle.
+        dx = ti.Vector([1, 0])
+        dy = ti.Vector([0, 1])
+        return ti.Vector([
+            self.get_distance(m, pos + dx) - self.get_distance(m, pos - dx),
+            self.get_distance(m, pos + dy) - self.get_distance(m, pos - dy)
+        ])
+
+    @ti.kernel
+    def init_map(self):
+        for m, i, j in self.bits:
+            self.bits[m, i, j] = 0
+
+    def init(self):
+        self.init_map()
+        self.version += 1
+
+    def state(self):
+        return get_fields(self, ["bits"])
+
+    def load_state(self, state):
+        set_fields(self, state, ["bits"])
+        self.version += 1
+
+    def from_numpy(self, mask):
+        # Packs a boolean map (one for all members, or one each) into the
+        # bit rows, least significant bit first.
+        mask = np.broadcast_to(
+            np.asarray(mask) != 0,
+            (self.members, self.size, self.size))
+        rows = np.zeros((self.members, self.size, self.words * 32),
+                        dtype=bool)
+        rows[..., :self.size] = mask
+        bits = np.packbits(rows, axis=-1, bitorder="little").view("<u4")
+        self.load_state({"bits": bits})
+
+    def draw(self, pos, value):
+        self.draw_brush(pos, value)
+        self.version += 1
+
+    @ti.kernel
+    def draw_brush(self, pos: vec2, value: ti.i32):
+        center = ti.cast(pos * self.size, ti.i32)
+        size = ti.cast(self.brush_size[None], ti.i32)
+        for m, i, j in ti.ndrange(self.members, (-size, size), (-size, size)):
+            if ti.Vector([i, j]).norm() <= self.brush_size[None]:
+                self.set(m, center + ti.Vector([i, j]), value)
+
+    @ti.kernel
+    def store_distance(self, inside: ti.template()):
+        for m, i, j in self.distance:
+            p = ti.Vector([i, j])
+            if self.occupied(m, p) == inside:
+                d = min(self.flood.offset(m, p).norm(), 127.0)
+                if ti.static(inside):
+                    d = -d
+                self.distance[m, i, j] = ti.cast(d, ti.i8)
+
+    def update_distance(self):
+        if self.distance_version != self.version:
+            if not self.bits.to_numpy().any():
+                # Nothing to flood from: every cell is as far as the clamp.
+                self.distance.fill(127)
+                self.distance_version = self.version
+                return
+            self.flood.run(self, self.distance)
+            self.store_distance(False)
+            self.flood.run(self, self.distance, True)
+            self.store_distance(True)
+            self.flood.release()
+            self.distance_version = self.version
+
+    @ti.kernel
+    def export(self, arr: ti.types.ndarray()):
+        for m, i, j in self.distance:
+            arr[m, i, j] = ti.cast(self.occupied(m, ti.Vector([i, j])),
+                                   ti.f32)
+
+    def to_numpy(self):
+        arr = np.zeros((self.members, self.size, self.size), dtype=np.float32)
+        self.export(arr)
+        return arr
@@ -0,0 +1,229 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from AntColony import *
+from sweep import DEFAULTS, build
+
+PUZZLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                      "puzzle.png")
+
+# Each suite scales one axis at a time away from a base case per model.
+SUITES = {
+    "quick": {
+        "ant": {
+            "base": {
+                "ants": 2000,
+                "grid": 256
+            },
+            "ants": [10000],
+            "grid": [512],
+            "detect_radius": [2, 40],
+            "puzzle": [True],
+            "deterministic": [True]
+        },
+        "slime": {
+            "base": {
+                "ants": 10000,
+                "grid": 256
+            },
+            "ants": [50000],
+            "detect_radius": [2, 40],
+            "slime_sensor": ["point"],
+            "sort_interval": [50],
+            "deterministic": [True]
+        }
+    },
+    "full": {
+        "ant": {
+            "base": {
+                "ants": 2000,
+                "grid": 512
+            },
+            "ants": [10000, 50000, 200000, 500000],
+            "grid": [256, 1024, 2048, 4096],
+            "detect_radius": [2, 5, 40],
+            "puzzle": [True],
+            "scenario": [PUZZLE],
+            "sparse": [True],
+            "sort_interval": [50]
+        },
+        "slime": {
+            "base": {
+                "ants": 50000,
+                "grid": 600
+            },
+            "ants": [2000, 200000, 500000],
+            "grid": [256, 1024, 2048, 4096],
+            "detect_radius": [2, 5, 40],
+            "sat_sensing": [True],
+            "diffuse_radius": [1, 3],
+            "slime_sensor": ["point", "bilinear"],
+            "sort_interval": [50]
+        }
+    }
+}
+
+
+def case_name(params):
+    name = "{mode}-n{ants}-g{grid}-r{detect_radius}".format(**params)
+    if params.get("puzzle"):
+        name += "-puzzle"
+    if params.get("scenario"):
+        name += "-scenario-" + os.path.splitext(
+            os.path.basename(params["scenario"]))[0]
+    if params.get("sparse"):
+        name += "-sparse"
+    if params["sat_sensing"]:
+        name += "-sat"
+    if params.get("slime_sensor", "sector") != "sector":
+        name += "-" + params["slime_sensor"]
+    if params.get("diffuse_radius"):
+        name += "-diff{}".format(params["diffuse_radius"])
+    if params["sort_interval"]:
+        name += "-sort{}".format(params["sort_interval"])
+    if params.get("deterministic"):
+        name += "-det"
+    return name
+
+
+def cases(suite):
+    runs = {}
+    for mode, axes in SUITES[suite].items():
+        base = dict(DEFAULTS[mode], mode=mode, repeat=0)
+        base.update(axes["base"])
+        runs[case_name(base)] = base
+        for axis, values in axes.items():
+            if axis == "base":
+                continue
+            for value in values:
+                params = dict(base)
+                params[axis] = value
+                runs[case_name(params)] = params
+    return runs
+
+
+def bench_case(params, steps, warmup, repeats, threads):
+    if threads:
+        init_taichi(ti.cpu, cpu_max_num_threads=threads, random_seed=0)
+    else:
+        init_taichi(ti.cpu, random_seed=0)
+    t = time.perf_counter()
+    sim = build(params)
+    setup = time.perf_counter() - t
+    # The first step compiles, or loads from the kernel cache, every kernel
+    # the model touches.
+    t = time.perf_counter()
+    sim.step()
+    ti.sync()
+    compile_s = time.perf_counter() - t
+    sim.step(warmup)
+    ti.sync()
+    # Deterministic cases record their state after the warmup, which must
+    # not change unless the model does.
+    checksum = sim.checksum() if sim.deterministic else None
+    rates = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        sim.step(steps)
+        ti.sync()
+        rates.append(steps / (time.perf_counter() - t))
+    # Per-stage breakdown from a separate pass, since the timers sync.
+    sim.metrics.timing = True
+    sim.step(max(steps // 4, 1))
+    stages = sim.metrics.snapshot()["stages"]
+    rates.sort()
+    return {
+        "setup_s": setup,
+        "compile_s": compile_s,
+        "steps_per_sec": rates[len(rates) // 2],
+        "best_steps_per_sec": rates[-1],
+        "ant_steps_per_sec": rates[len(rates) // 2] * sim.ants.N,
+        "stages_ms": {name: stage["avg_ms"]
+                      for name, stage in stages.items()},
+        "checksum": checksum,
+        "checksum_steps": 1 + warmup,
+        # ru_maxrss is in KiB on Linux.
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+        1024
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["steps_per_sec"] / baseline[name]["steps_per_sec"]
+        print("{:40s} {:6.2f}x baseline".format(name, ratio))
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+        expected = baseline[name].get("checksum")
+        if expected and result["checksum_steps"] == baseline[name].get(
+                "checksum_steps") and result["checksum"] != expected:
+            print("{:40s} state differs from baseline".format(name))
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ant and slime models headless on the CPU.")
+    parser.add_argument("--suite", choices=list(SUITES), default="quick")
+    parser.add_argument("--only",
+                        default="",
+                        help="run only cases whose name contains this")
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--out", default=None, help="write results as JSON")
+    parser.add_argument("--baseline",
+                        default=None,
+                        help="JSON results to compare against")
+    parser.add_argument("--save-baseline",
+                        action="store_true",
+                        help="write the results to --baseline instead")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.1,
+                        help="allowed steps/sec loss against the baseline")
+    args = parser.parse_args()
+
+    results = {}
+    # One fresh process per case, so compile caches and peak memory do not
+    # carry over between cases.
+    context = multiprocessing.get_context("spawn")
+    for name, params in cases(args.suite).items():
+        if args.only not in name:
+            continue
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(bench_case, params, args.steps, args.warmup,
+                                 args.repeats, args.threads).result()
+        results[name] = result
+        print("{:40s} {:9.1f} steps/s {:12.0f} ant-steps/s "
+              "compile {:5.2f}s peak {:7.1f} MB".format(
+                  name, result["steps_per_sec"], result["ant_steps_per_sec"],
+                  result["compile_s"], result["peak_rss_mb"]))
+        for stage, ms in sorted(result["stages_ms"].items(),
+                                key=lambda item: -item[1]):
+            print("    {:24s} {:8.3f} ms".format(stage, ms))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("regressions: " + ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,77 @@
+import argparse
+import multiprocessing
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Nothing from Taichi or the model is imported here, so that a worker
+# started from this module pays for those imports inside the timing.
+
+STAGES = ("import", "ti.init", "fields", "init", "first step")
+
+
+def start_worker(mode, cache, threads):
+    # Times the start of a sweep worker from a fresh process, up to the end
+    # of its first step, which compiles or loads every kernel it needs.
+    times = {}
+    t = time.perf_counter()
+    import sweep
+    from AntColony import KERNEL_CACHE, init_taichi, ti
+    times["import"] = time.perf_counter() - t
+    t = time.perf_counter()
+    init_taichi(ti.cpu,
+                offline_cache_file_path=cache or KERNEL_CACHE,
+                cpu_max_num_threads=threads)
+    times["ti.init"] = time.perf_counter() - t
+    params = dict(sweep.DEFAULTS[mode], mode=mode, repeat=0)
+    t = time.perf_counter()
+    sim = sweep.create(params)
+    times["fields"] = time.perf_counter() - t
+    t = time.perf_counter()
+    sweep.prepare(sim, params)
+    ti.sync()
+    times["init"] = time.perf_counter() - t
+    t = time.perf_counter()
+    sim.step()
+    ti.sync()
+    times["first step"] = time.perf_counter() - t
+    return times
+
+
+def measure(mode, cache, threads):
+    # Taichi runtimes do not survive fork, so each start is spawned.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(start_worker, mode, cache, threads).result()
+
+
+def report(label, times):
+    print("{:12s}".format(label) +
+          "".join("{:>12.3f}".format(times[s]) for s in STAGES) +
+          "{:>10.3f}".format(sum(times.values())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time a worker's cold and warm start.")
+    parser.add_argument("--mode", choices=["ant", "slime"], default="ant")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--cache",
+                        default=None,
+                        help="kernel cache to warm and time, instead of a "
+                        "new, empty one")
+    args = parser.parse_args()
+
+    cache = args.cache or tempfile.mkdtemp(prefix="ti_cache_")
+    print("{:12s}".format("seconds") +
+          "".join("{:>12s}".format(s) for s in STAGES) +
+          "{:>10s}".format("total"))
+    try:
+        # The first start compiles into the cache, unless it is already
+        # warm, and the second loads from it.
+        report("first", measure(args.mode, cache, args.threads))
+        report("second", measure(args.mode, cache, args.threads))
+    finally:
+        if not args.cache:
+            shutil.rmtree(cache, ignore_errors=True)
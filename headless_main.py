@@ -0,0 +1,25 @@
+import time
+
+from AntColony import *
+
+init_taichi(ti.cpu)
+dt = 1e-3
+
+rdr = Renderer(512, 512, headless=True)
+
+ph = Detectables(rdr, 0.2 * dt, 1.0, 1.0)
+pf = Detectables(rdr, 0.2 * dt, 2.0, 2.0)
+ants = Ants(2000, 1.0, pf, ph, 1.5, 10.0)
+sim = Simulation(rdr, ants, ph, pf)
+
+if __name__ == "__main__":
+    sim.init()
+    sim.set_puzzle()
+    sim.step()
+    ti.sync()
+    t = time.perf_counter()
+    sim.step(1000)
+    ti.sync()
+    elapsed = time.perf_counter() - t
+    print("{} steps in {:.2f}s, {:.0f} ant-steps/sec".format(
+        1000, elapsed, 1000 * ants.N / elapsed))
@@ -0,0 +1,20 @@
+from AntColony import *
+
+init_taichi(ti.gpu)
+dt = 1e-3
+world = 8192
+
+# An 8192x8192 world seen through a 768x768 window. Pan with the arrow
+# keys, zoom with z and x. Speeds and radii are in world units, so they are
+# scaled down to keep ants moving as far per step, in cells, as in main.py.
+rdr = Renderer(world, 768, "Large World")
+
+ph = Detectables(rdr, 0.2 * dt, 1.0, 1.0, sparse=True)
+pf = Detectables(rdr, 0.2 * dt, 2.0, 2.0, sparse=True)
+ants = Ants(2000, 512 / world, pf, ph, 1.5, 10.0)
+ac = AntColony(rdr, ants, ph, pf)
+ac.sim.home_radius = 0.02 * 512 / world
+ac.zoom = world / 512
+
+if __name__ == "__main__":
+    ac.run()
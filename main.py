@@ -1,6 +1,6 @@
 from AntColony import *
 
-ti.init(arch=ti.gpu)
+init_taichi(ti.gpu)
 dt = 1e-3
 
 rdr = Renderer(512, 512)
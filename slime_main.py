@@ -1,13 +1,23 @@
 from AntColony import *
 
-ti.init(arch=ti.gpu)
+init_taichi(ti.gpu)
 dt = 1e-3
 
 rdr = Renderer(600, 600, "Slime Simulation")
 
-ph = Detectables(rdr, 5.0 * dt, 1.0, 1.0)
-pf = Detectables(rdr, 5.0 * dt, 1.0, 1.0)
-ants = Ants(50000, 1.0, pf, ph, 0.1, 10.0)
+ph = Detectables(rdr,
+                 5.0 * dt,
+                 1.0,
+                 1.0,
+                 diffuse_radius=1,
+                 diffuse_rate=0.2)
+pf = Detectables(rdr,
+                 5.0 * dt,
+                 1.0,
+                 1.0,
+                 diffuse_radius=1,
+                 diffuse_rate=0.2)
+ants = Ants(50000, 1.0, pf, ph, 0.1, 10.0, slime_sensor="bilinear")
 ac = AntColony(rdr, ants, ph, pf)
 
 if __name__ == "__main__":
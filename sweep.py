@@ -0,0 +1,378 @@
+import argparse
+import ast
+import csv
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from AntColony import *
+
+# Resampled scenario grids, shared by the workers of a sweep.
+SCENARIO_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              ".scenario_cache")
+
+# Baseline parameters of main.py and slime_main.py; every sweep axis
+# overrides one of these. Decay rates are in units of dt as in the scripts.
+DEFAULTS = {
+    "ant": {
+        "grid": 512,
+        "ants": 2000,
+        "speed": 1.0,
+        "sensitivity": 1.5,
+        "clock_delta": 10.0,
+        "detect_radius": 14,
+        "sat_sensing": False,
+        "sort_interval": 0,
+        "storage": "f32",
+        "diffuse_radius": 0,
+        "diffuse_kernel": "box",
+        "diffuse_rate": 1.0,
+        "deterministic": False,
+        "ph_decay": 0.2,
+        "pf_decay": 0.2,
+        "ph_value": 1.0,
+        "pf_value": 2.0,
+        "sparse": False,
+        "capacity": None,
+        "spawn_per_food": 0,
+        "starve": False,
+        "puzzle": False,
+        "scenario": None,
+        "food_pos": (0.8, 0.8),
+        "food_radius": 10,
+    },
+    "slime": {
+        "grid": 600,
+        "ants": 50000,
+        "speed": 1.0,
+        "sensitivity": 0.1,
+        "clock_delta": 10.0,
+        "detect_radius": 14,
+        "sat_sensing": False,
+        "sort_interval": 0,
+        "storage": "f32",
+        "diffuse_radius": 0,
+        "diffuse_kernel": "box",
+        "diffuse_rate": 1.0,
+        "deterministic": False,
+        "slime_sensor": "sector",
+        "ph_decay": 5.0,
+        "pf_decay": 5.0,
+        "ph_value": 1.0,
+        "pf_value": 1.0,
+    },
+}
+
+
+def expand(mode, grid, repeats=1):
+    # Cartesian product of the sweep axes over the mode's defaults.
+    names = list(grid)
+    runs = []
+    for values in itertools.product(*(grid[n] for n in names)):
+        for repeat in range(repeats):
+            params = dict(DEFAULTS[mode])
+            params.update(zip(names, values))
+            params["mode"] = mode
+            params["repeat"] = repeat
+            params["run"] = len(runs)
+            runs.append(params)
+    return runs
+
+
+def create(params, dt=1e-3):
+    # Allocates the fields of a run; prepare runs its init kernels.
+    # Only the sector sensors of the slime model read summed-area tables.
+    summed_area = (params["mode"] == "slime" and
+                   params.get("slime_sensor", "sector") == "sector")
+    rdr = Renderer(params["grid"], params["grid"], headless=True)
+    ph = Detectables(rdr,
+                     params["ph_decay"] * dt,
+                     params["ph_value"],
+                     params["ph_value"],
+                     summed_area=summed_area,
+                     storage=params["storage"],
+                     sparse=params.get("sparse", False),
+                     diffuse_radius=params.get("diffuse_radius", 0),
+                     diffuse_kernel=params.get("diffuse_kernel", "box"),
+                     diffuse_rate=params.get("diffuse_rate", 1.0),
+                     deterministic=params.get("deterministic", False))
+    pf = Detectables(rdr,
+                     params["pf_decay"] * dt,
+                     params["pf_value"],
+                     params["pf_value"],
+                     summed_area=summed_area,
+                     storage=params["storage"],
+                     sparse=params.get("sparse", False),
+                     diffuse_radius=params.get("diffuse_radius", 0),
+                     diffuse_kernel=params.get("diffuse_kernel", "box"),
+                     diffuse_rate=params.get("diffuse_rate", 1.0),
+                     deterministic=params.get("deterministic", False))
+    ants = Ants(params["ants"],
+                params["speed"],
+                pf,
+                ph,
+                params["sensitivity"],
+                params["clock_delta"],
+                dt=dt,
+                sat_sensing=params["sat_sensing"],
+                detect_radius=params["detect_radius"],
+                sort_interval=params["sort_interval"],
+                capacity=params.get("capacity"),
+                spawn_per_food=params.get("spawn_per_food", 0),
+                starve=params.get("starve", False),
+                slime_sensor=params.get("slime_sensor", "sector"),
+                deterministic=params.get("deterministic", False))
+    return Simulation(rdr, ants, ph, pf)
+
+
+def prepare(sim, params):
+    # Deterministic runs are seeded by the repeat too.
+    if params["mode"] == "slime":
+        sim.slime_init(seed=params["repeat"])
+    else:
+        sim.init(seed=params["repeat"])
+        if params.get("scenario"):
+            # A scenario brings its own obstacles, food and home.
+            sim.load_scenario(
+                Scenario.load(params["scenario"], cache_dir=SCENARIO_CACHE))
+            return sim
+        if params["puzzle"]:
+            sim.set_puzzle()
+        sim.foods.brush_size[None] = params["food_radius"]
+        sim.foods.draw(ti.Vector(list(params["food_pos"])), 2)
+    return sim
+
+
+def build(params, dt=1e-3):
+    return prepare(create(params, dt), params)
+
+
+# Columns every result row has besides the parameters; a failed run
+# leaves them empty except steps and error.
+RESULT_COLUMNS = ("steps", "food_delivered", "food_left", "food_taken",
+                  "coverage", "warmup_s", "elapsed_s", "steps_per_sec",
+                  "population", "ant_steps_per_sec", "checksum", "error")
+
+
+def failed(params, steps, error):
+    result = dict(params)
+    result.update(dict.fromkeys(RESULT_COLUMNS))
+    result.update({
+        "steps": steps,
+        "error": "{}: {}".format(type(error).__name__, error)
+    })
+    return result
+
+
+def run_one(params, steps, threads):
+    # A run that raises, e.g. on an invalid combination of parameters, is
+    # reported as a row instead of ending the sweep.
+    try:
+        return measure(params, steps, threads)
+    except Exception as e:
+        ti.reset()
+        return failed(params, steps, e)
+
+
+def measure(params, steps, threads):
+    # Each run gets a fresh Taichi runtime so fields from earlier runs in
+    # this worker are released; repeats differ only in the random seed.
+    # Deterministic runs draw from the counter RNG seeded in prepare(), so
+    # they keep Taichi's seed, which is part of the kernel cache key, at 0
+    # and share one set of compiled kernels.
+    seed = 0 if params.get("deterministic") else params["repeat"]
+    init_taichi(ti.cpu, cpu_max_num_threads=threads, random_seed=seed)
+    sim = build(params)
+    food = sim.food_map().sum()
+    t = time.perf_counter()
+    sim.step()
+    ti.sync()
+    warmup = time.perf_counter() - t
+    ant_steps = sim.ant_steps()
+    t = time.perf_counter()
+    sim.step(steps - 1)
+    ti.sync()
+    elapsed = time.perf_counter() - t
+    ant_steps = sim.ant_steps() - ant_steps
+    result = dict(params)
+    result.update({
+        "steps": steps,
+        "food_delivered": int(sim.delivered()),
+        "food_left": float(sim.food_map().sum()),
+        "food_taken": float(food - sim.food_map().sum()),
+        "coverage": float(sim.coverage()),
+        "warmup_s": warmup,
+        "elapsed_s": elapsed,
+        "steps_per_sec": (steps - 1) / elapsed,
+        "population": int(sim.population()),
+        "ant_steps_per_sec": ant_steps / elapsed,
+        "checksum": sim.checksum() if sim.deterministic else "",
+        "error": None,
+    })
+    ti.reset()
+    return result
+
+
+class ResultWriter:
+    # Appends one row per finished run, to CSV or, if the path ends with
+    # .parquet and pyarrow is installed, to Parquet row groups.
+    def __init__(self, path, flush_every=8):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self.flush_every = flush_every
+        self.rows = []
+        self.file = None
+        self.writer = None
+
+    def write(self, row):
+        row = {
+            k: str(v) if isinstance(v, (tuple, list)) else v
+            for k, v in row.items()
+        }
+        if self.parquet:
+            self.rows.append(row)
+            if len(self.rows) >= self.flush_every:
+                self.flush()
+            return
+        if self.writer is None:
+            self.file = open(self.path, "w", newline="")
+            self.writer = csv.DictWriter(self.file, fieldnames=list(row))
+            self.writer.writeheader()
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(self.rows)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        if self.parquet:
+            self.flush()
+            if self.writer is not None:
+                self.writer.close()
+        elif self.file is not None:
+            self.file.close()
+
+
+def sweep(runs, out, steps=1000, workers=None, threads=1):
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    # Taichi runtimes do not survive fork, so workers are spawned.
+    context = multiprocessing.get_context("spawn")
+    writer = ResultWriter(out)
+    # Runs that failed or never finished.
+    errors = 0
+
+    def record(result):
+        nonlocal errors
+        writer.write(result)
+        if result["error"] is not None:
+            errors += 1
+            print("run {} failed: {}".format(result["run"], result["error"]))
+        else:
+            print("run {} done: {} food delivered, {:.0f} steps/sec".format(
+                result["run"], result["food_delivered"],
+                result["steps_per_sec"]))
+
+    try:
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            futures = {}
+            if workers > 1 and len(runs) > 1:
+                # The first run fills the kernel cache, so the other
+                # workers load its kernels instead of all compiling them.
+                first = pool.submit(run_one, runs[0], steps, threads)
+                futures[first] = runs[0]
+                wait([first])
+                runs = runs[1:]
+            for params in runs:
+                futures[pool.submit(run_one, params, steps, threads)] = params
+            pending = set(futures)
+            for future in as_completed(futures):
+                pending.discard(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    # A worker died outright, e.g. in a segfault, and took
+                    # the pool with it; keep what did finish and stop.
+                    pool.shutdown(cancel_futures=True)
+                    lost = 1
+                    for other in pending:
+                        if other.done() and not other.cancelled(
+                        ) and other.exception() is None:
+                            record(other.result())
+                        else:
+                            lost += 1
+                    errors += lost
+                    print("a worker process died; {} runs did not finish".
+                          format(lost))
+                    break
+                except Exception as e:
+                    result = failed(futures[future], steps, e)
+                record(result)
+    finally:
+        writer.close()
+    return errors
+
+
+def parse_value(text):
+    # A Python literal, or the bare text for strings such as u8 or paths.
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_axis(text):
+    # name=v1,v2,... e.g. sensitivity=0.5,1.5 or food_pos=(0.2,0.2),(0.8,0.8);
+    # commas inside brackets or quotes belong to the value.
+    name, values = text.split("=", 1)
+    items, depth, quote, start = [], 0, None, 0
+    for k, c in enumerate(values + ","):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth -= 1
+        elif c == "," and depth == 0:
+            items.append(values[start:k].strip())
+            start = k + 1
+    return name, [parse_value(v) for v in items if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a headless parameter sweep.")
+    parser.add_argument("axes",
+                        nargs="*",
+                        help="sweep axes as name=v1,v2,...")
+    parser.add_argument("--mode", choices=list(DEFAULTS), default="ant")
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads",
+                        type=int,
+                        default=1,
+                        help="Taichi CPU threads per worker")
+    parser.add_argument("--out", default="sweep.csv")
+    args = parser.parse_args()
+    grid = dict(parse_axis(axis) for axis in args.axes)
+    for name in grid:
+        if name not in DEFAULTS[args.mode]:
+            parser.error("unknown parameter " + name)
+    errors = sweep(expand(args.mode, grid, args.repeats), args.out,
+                   args.steps, args.workers, args.threads)
+    if errors:
+        raise SystemExit(1)
@@ -0,0 +1,9 @@
+import pytest
+import taichi as ti
+
+
+@pytest.fixture(autouse=True)
+def runtime():
+    ti.init(arch=ti.cpu, random_seed=0)
+    yield
+    ti.reset()
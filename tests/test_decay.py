@@ -0,0 +1,48 @@
+import pytest
+
+from AntColony import *
+
+
+def paint(things, steps):
+    # Overlapping brushes laid down between runs of decay, so tiles are
+    # activated, retired and revived.
+    for k, pos in enumerate(((0.1, 0.1), (0.5, 0.52), (0.45, 0.5))):
+        things.brush_size[None] = 5 + 4 * k
+        things.draw(ti.Vector(pos), 1 + k // 2)
+        for _ in range(steps):
+            yield
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("storage", ["f32", "u8"])
+def test_tile_decay_matches_dense(sparse, storage):
+    rdr = Renderer(128, 128, headless=True)
+    kw = dict(storage=storage, members=2, deterministic=True)
+    tiled = Detectables(rdr, 0.01, 2.0, 1.0, sparse=sparse, **kw)
+    dense = Detectables(rdr, 0.01, 2.0, 1.0, **kw)
+    for things in (tiled, dense):
+        things.init()
+    for _ in zip(paint(tiled, 60), paint(dense, 60)):
+        tiled.decay()
+        # Flagging every tile makes decay sweep the whole grid.
+        dense.tiles.fill(1)
+        dense.decay()
+        assert np.array_equal(tiled.to_numpy(), dense.to_numpy())
+    assert tiled.tiles.to_numpy().sum() < dense.tiles.to_numpy().size
+
+
+def test_lazy_matches_eager():
+    # A power-of-two rate keeps the arithmetic exact, so the closed form
+    # must agree with stepwise decay bit for bit, through the clamp at 0.
+    rdr = Renderer(64, 64, headless=True)
+    eager = Detectables(rdr, 2**-7, 2.0, 1.0)
+    lazy = Detectables(rdr, 2**-7, 2.0, 1.0, lazy_decay=True)
+    for things in (eager, lazy):
+        things.init()
+    for k, _ in enumerate(zip(paint(eager, 100), paint(lazy, 100))):
+        eager.decay()
+        lazy.decay()
+        if k % 25 == 0:
+            assert np.array_equal(eager.to_numpy(), lazy.to_numpy())
+    assert np.array_equal(eager.to_numpy(), lazy.to_numpy())
+    assert eager.to_numpy().any()
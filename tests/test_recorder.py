@@ -0,0 +1,41 @@
+import shutil
+
+import pytest
+
+from AntColony import *
+
+
+def test_circles_reach_the_frame(tmp_path):
+    image = ti.Vector.field(3, dtype=ti.f32, shape=(64, 64))
+    centers = ti.Vector.field(2, dtype=ti.f32, shape=2)
+    centers.from_numpy(np.array([[0.25, 0.75], [-1.0, -1.0]], np.float32))
+    recorder = Recorder(str(tmp_path / "frames"), 64, buffers=1, drop=False)
+    recorder.capture(image, circles=[(centers, 0.001, (1.0, 1.0, 1.0))])
+    recorder.close()
+    frame = recorder.buffers[0]
+    # One pixel for a sub-pixel ant at x = 16, y = 48 from the bottom.
+    assert (frame[:, :, 0] > 0).sum() == 1
+    assert frame[63 - 48, 16, 0] == 255
+
+
+def test_encoding_errors_are_raised(tmp_path):
+    image = ti.Vector.field(3, dtype=ti.f32, shape=(16, 16))
+    path = tmp_path / "frames"
+    recorder = Recorder(str(path), 16, buffers=1, drop=False)
+    shutil.rmtree(path)
+    # With a single buffer the second capture waits for the failed first.
+    with pytest.raises(RuntimeError):
+        for _ in range(3):
+            recorder.capture(image)
+    with pytest.raises(RuntimeError):
+        recorder.close()
+
+
+def test_map_size_must_match(tmp_path):
+    rdr = Renderer(128, 64, headless=True)
+    things = Detectables(rdr, 2e-4, 1.0, 1.0)
+    recorder = Recorder(str(tmp_path / "frames"), 64)
+    with pytest.raises(ValueError):
+        recorder.capture_map(things)
+    recorder.close()
+    assert recorder.written == 0
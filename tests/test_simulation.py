@@ -0,0 +1,12 @@
+import pytest
+
+from AntColony import *
+
+
+def test_members_must_match():
+    rdr = Renderer(64, 64, headless=True)
+    ph = Detectables(rdr, 2e-4, 1.0, 1.0)
+    pf = Detectables(rdr, 2e-4, 2.0, 2.0)
+    ants = Ants(500, 1.0, pf, ph, 1.5, 10.0, members=3)
+    with pytest.raises(ValueError):
+        Simulation(rdr, ants, ph, pf)
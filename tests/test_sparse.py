@@ -0,0 +1,19 @@
+from AntColony import *
+from sweep import DEFAULTS, build
+
+
+def test_sparse_obstacles_and_food():
+    # At this size the puzzle walls cross the spawn circle, so ants get
+    # parked at the origin; they used to wrap to 1.0 and read one tile past
+    # the sparse maps, which segfaulted within a few steps.
+    params = dict(DEFAULTS["ant"],
+                  mode="ant",
+                  repeat=0,
+                  grid=128,
+                  puzzle=True,
+                  sparse=True)
+    sim = build(params)
+    sim.step(200)
+    pos = sim.ants.pos.to_numpy()
+    assert ((pos >= 0.0) & (pos < 1.0)).all()
+    assert sim.food_map().sum() > 0
@@ -0,0 +1,23 @@
+from sweep import DEFAULTS, RESULT_COLUMNS, parse_axis, run_one
+
+
+def test_parse_axis():
+    assert parse_axis("storage=u8,f16") == ("storage", ["u8", "f16"])
+    assert parse_axis("scenario=data/puzzle.png,None") == (
+        "scenario", ["data/puzzle.png", None])
+    assert parse_axis("sensitivity=0.5,1.5,") == ("sensitivity", [0.5, 1.5])
+    assert parse_axis("food_pos=(0.2, 0.2),(0.8, 0.8)") == (
+        "food_pos", [(0.2, 0.2), (0.8, 0.8)])
+
+
+def test_failed_run_is_a_row():
+    params = dict(DEFAULTS["ant"],
+                  mode="ant",
+                  repeat=0,
+                  run=0,
+                  grid=128,
+                  sparse=True,
+                  diffuse_radius=1)
+    result = run_one(params, 10, 1)
+    assert result["error"].startswith("ValueError")
+    assert set(RESULT_COLUMNS) <= set(result)